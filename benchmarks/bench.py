@@ -0,0 +1,335 @@
+"Benchmarks for the SetBG rendering pipeline and directory scanner"
+
+from argparse import ArgumentParser
+from json import dump, load
+from os import environ, makedirs
+from os.path import join as pjoin
+from platform import python_version
+from statistics import median
+from subprocess import run
+from sys import executable, path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+RESOLUTIONS = ["1920x1080", "2560x1440", "3840x2160", "5120x1440"]
+SCAN_SIZES = [10_000, 100_000]
+STARTUP = ["setbg.rbgn", "setbg.setbg", "setbg.rbg"]  # modules to import
+THRESHOLD = 0.10  # slow down that counts as a regression
+# tile sizes the compositing engines are compared at
+TILES = [(7, 5), (64, 48), (128, 96), (600, 400), (1000, 800), (1900, 1000)]
+
+# name: (mode, size, format)
+CORPUS = {
+    "tile": ("RGB", (64, 48), "JPEG"),
+    "portrait": ("RGB", (1080, 1920), "JPEG"),
+    "phone": ("RGB", (3024, 4032), "JPEG"),
+    "ultrawide": ("RGB", (5120, 1080), "JPEG"),
+    "huge": ("RGB", (6000, 4000), "JPEG"),
+    "palette": ("P", (800, 600), "PNG"),
+    "rgba": ("RGBA", (1200, 800), "PNG"),
+}
+
+
+def setup_home(home: str) -> None:
+    "point HOME at a scratch directory before setbg is imported"
+    from PIL.Image import new as imnew
+
+    environ["HOME"] = home
+    makedirs(pjoin(home, "Documents"))
+    makedirs(pjoin(home, ".bg"))
+    imnew("RGB", (640, 480), "gray").save(pjoin(home, "Documents", "RSBG.jpg"))
+
+
+def make_corpus(dir: str) -> dict[str, str]:
+    "write the synthetic images, noise so encoders do real work"
+    from PIL.Image import effect_noise
+
+    paths = {}
+    for name, (mode, size, fmt) in CORPUS.items():
+        img = effect_noise(size, 64).convert("RGB")
+        if mode == "P":
+            img = img.quantize(256)
+        elif mode == "RGBA":
+            img.putalpha(128)
+        paths[name] = pjoin(dir, f"{name}.{fmt.lower()}")
+        img.save(paths[name], fmt)
+    return paths
+
+
+def make_tree(dir: str, count: int, per_dir=100) -> str:
+    "empty files in a two level tree, one in ten not an image"
+    root = pjoin(dir, f"tree{count}")
+    for i in range(count):
+        sub = pjoin(root, f"d{i // (per_dir * 10)}", f"s{i // per_dir}")
+        if i % per_dir == 0:
+            makedirs(sub)
+        ext = "txt" if i % 10 == 0 else "jpg"
+        open(pjoin(sub, f"{i}.{ext}"), "w").close()
+    return root
+
+
+def timeit(func, repeat: int) -> dict[str, float]:
+    "median and best wall time of repeat calls"
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return {"median": median(times), "min": min(times), "runs": repeat}
+
+
+def bench_render(paths: dict[str, str], out: str, repeat: int) -> dict:
+    "time each pipeline stage and full renders per resolution"
+    from setbg import setbg
+    from setbg.common import r
+    from setbg.pyramid import Pyramid
+
+    results = {}
+    dst = pjoin(out, "bg.jpg")
+    for res in RESOLUTIONS:
+        r[0], r[1] = (int(x) for x in res.split("x"))
+        size = (r[0], r[1])
+        for name, path in paths.items():
+            key = f"{res}/{name}"
+            image = setbg.open_image(path, size)
+            scaled = setbg.scale_image(image, size)
+            tiled = setbg.tile_image(scaled, size)
+            striped = setbg.stripe_image(tiled, image, size)
+            stages = {
+                "decode": lambda: setbg.open_image(path, size),
+                "scale": lambda: setbg.scale_image(image, size),
+                "tile": lambda: setbg.tile_image(scaled, size),
+                "tile-paste": lambda: tile_with("paste", scaled, size),
+                "stripe": lambda: setbg.stripe_image(tiled, image, size),
+                "stripe-pyramid": lambda: setbg.stripe_image(
+                    tiled, image, size, levels=Pyramid(image)
+                ),
+                "save": lambda: striped.save(dst),
+                "render": lambda: setbg.gen_image(path, dst),
+            }
+            for stage, func in stages.items():
+                results[f"{key}/{stage}"] = timeit(func, repeat)
+    return results
+
+
+def tile_with(mode: str, image, size: tuple[int, int]):
+    "tile with a given compositing engine, for comparing against the default"
+    from setbg import setbg
+    from setbg.common import composite
+
+    (saved, composite[0]) = (composite[0], mode)
+    try:
+        return setbg.tile_image(image, size)
+    finally:
+        composite[0] = saved
+
+
+def bench_tile(repeat: int) -> dict:
+    "time the default compositing engine and paste for each tile size"
+    from PIL.Image import effect_noise
+
+    from setbg.common import COMPOSITE
+
+    results = {}
+    for res in RESOLUTIONS:
+        size = tuple(int(x) for x in res.split("x"))
+        for tw, th in TILES:
+            tile = effect_noise((tw, th), 64).convert("RGB")
+            for mode in (COMPOSITE, "paste"):
+                # the first call pays for growing the heap
+                tile_with(mode, tile, size)
+                results[f"tile/{res}/{tw}x{th}/{mode}"] = timeit(
+                    lambda: tile_with(mode, tile, size), repeat
+                )
+    return results
+
+
+def tile_check(results: dict) -> list[str]:
+    "tile sizes where the default engine is slower than paste"
+    from setbg.common import COMPOSITE, TILE_PASTE
+
+    slower = []
+    for name, now in results.items():
+        if not name.startswith("tile/") or not name.endswith("/paste"):
+            continue
+        (_, res, tile, _) = name.split("/")
+        sizes = zip(res.split("x"), tile.split("x"))
+        (cx, cy) = (int(s) // int(t) for s, t in sizes)
+        if cx * cy <= TILE_PASTE:
+            # the default pastes these too, any gap is noise
+            continue
+        default = results[name.replace("/paste", f"/{COMPOSITE}")]
+        if default["min"] > now["min"]:
+            slower.append(name.rsplit("/", 1)[0])
+    return slower
+
+
+def bench_apply(paths: dict[str, str], repeat: int) -> dict:
+    "time a cached switch with the WM call stubbed out"
+    from setbg import setbg
+    from setbg.common import r, window_manager
+
+    r[0], r[1] = 1920, 1080
+    setbg.system_name = "Linux"
+    window_manager[:] = ["Xfwm4"]
+    setbg.xfwm4 = lambda bg_name, monitor="": None
+    setbg.set_background(paths["huge"])
+    return {
+        "apply/cached": timeit(
+            lambda: setbg.set_background(paths["huge"]), repeat
+        )
+    }
+
+
+FAKE_XFCONF = """#!/bin/sh
+case "$*" in
+*--list*)
+    for m in 0 1 2; do
+        for w in 0 1 2 3; do
+            p=/backdrop/screen0/monitor$m/workspace$w
+            echo $p/last-image
+            echo $p/image-style
+        done
+    done
+    ;;
+esac
+"""
+
+
+def bench_xfconf(dir: str, repeat: int) -> dict:
+    "time the xfwm4 backend against a fake 3 monitor 4 workspace xfconf"
+    from os import chmod
+
+    from setbg import setbg, xfce
+
+    script = pjoin(dir, "xfconf-query")
+    with open(script, "w") as fp:
+        fp.write(FAKE_XFCONF)
+    chmod(script, 0o755)
+    xfce.XFCONF[0] = script
+    bg_name = pjoin(dir, "home", ".bg", "bg.jpg")
+    open(bg_name, "w").close()
+
+    def cold():
+        xfce.image_props.clear()
+        xfce.styled.clear()
+        setbg.xfwm4(bg_name)
+
+    return {
+        "xfconf/cold": timeit(cold, repeat),
+        "xfconf/warm": timeit(lambda: setbg.xfwm4(bg_name), repeat),
+    }
+
+
+def bench_scan(dir: str, sizes: list[int], repeat: int) -> dict:
+    "time directory tree scans cold and through a warm index"
+    from setbg.index import ScanIndex
+    from setbg.rbg import Images
+
+    results = {}
+    for count in sizes:
+        root = make_tree(dir, count)
+        images = Images()
+        results[f"scan/{count}/walk"] = timeit(
+            lambda: images.scan_tree(root), repeat
+        )
+        db = pjoin(dir, f"index{count}.db")
+
+        def cold():
+            index = ScanIndex(True, db)
+            for _ in index.walk([root]):
+                pass
+            index.close()
+
+        results[f"scan/{count}/index-cold"] = timeit(cold, 1)
+        images.scan_index = ScanIndex(False, db)
+        results[f"scan/{count}/index-warm"] = timeit(
+            lambda: images.scan_tree(root), repeat
+        )
+        images.scan_index.close()
+    return results
+
+
+def bench_startup(repeat: int) -> dict:
+    "time fresh interpreters importing each entry point module"
+    env = dict(environ, PYTHONPATH=":".join(p for p in sys_path if p))
+    results = {
+        "startup/python": timeit(
+            lambda: run([executable, "-c", "pass"], env=env, check=True),
+            repeat,
+        )
+    }
+    for module in STARTUP:
+        results[f"startup/{module}"] = timeit(
+            lambda: run(
+                [executable, "-c", f"import {module}"], env=env, check=True
+            ),
+            repeat,
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict) -> list[str]:
+    "names of benchmarks slower than the baseline by more than THRESHOLD"
+    slower = []
+    print(f"{'benchmark':44} {'base':>9} {'now':>9} {'change':>8}")
+    for name, now in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]["median"]
+        change = (now["median"] - base) / base if base else 0.0
+        flag = " <-" if change > THRESHOLD else ""
+        if flag:
+            slower.append(name)
+        print(
+            f"{name:44} {base:9.4f} {now['median']:9.4f} {change:+8.1%}{flag}"
+        )
+    return slower
+
+
+def main() -> int:
+    "run the selected benchmarks and write results as JSON"
+    parser = ArgumentParser(description="SetBG benchmarks")
+    parser.add_argument("-o", "--output", default="bench.json")
+    parser.add_argument("-b", "--baseline", help="results file to compare")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument(
+        "-s",
+        "--scan-sizes",
+        default=",".join(str(x) for x in SCAN_SIZES),
+        help="comma separated file counts for scan trees, empty skips",
+    )
+    parser.add_argument("--no-render", action="store_true")
+    parser.add_argument("--no-startup", action="store_true")
+    args = parser.parse_args()
+    results: dict = {}
+    with TemporaryDirectory(prefix="setbg-bench-") as tmp:
+        setup_home(pjoin(tmp, "home"))
+        corpus = pjoin(tmp, "corpus")
+        makedirs(corpus)
+        paths = make_corpus(corpus)
+        if not args.no_render:
+            results.update(bench_render(paths, tmp, args.repeat))
+            results.update(bench_tile(args.repeat))
+            for name in tile_check(results):
+                print(f"{name}: default compositing slower than paste")
+            results.update(bench_xfconf(tmp, args.repeat))
+            results.update(bench_apply(paths, args.repeat))
+        if not args.no_startup:
+            results.update(bench_startup(max(args.repeat, 5)))
+        sizes = [int(x) for x in args.scan_sizes.split(",") if x]
+        results.update(bench_scan(tmp, sizes, args.repeat))
+    with open(args.output, "w") as fp:
+        dump({"python": python_version(), "results": results}, fp, indent=1)
+    print(f"wrote {len(results)} results to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as fp:
+            slower = compare(results, load(fp)["results"])
+        if slower:
+            print(f"{len(slower)} regressions over {THRESHOLD:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,195 @@
+from collections import OrderedDict
+from hashlib import sha1
+from logging import getLogger
+from os import link, listdir, makedirs, remove, replace, stat, utime
+from os.path import basename, exists, samefile, splitext
+from shutil import copyfile
+from threading import Lock
+
+from os.path import join as pjoin
+
+from setbg.common import (
+    BG_HOME,
+    CACHE_DIR,
+    ENC,
+    ENCODERS,
+    FLIP_FIRST,
+    LNAME,
+    PYRAMID_GAP,
+    SCALE_MAX,
+    TOLERANCE,
+)
+from setbg.common import BadImage
+from setbg.common import cache_max, out_ext
+
+log = getLogger(LNAME)
+
+cache_home = pjoin(BG_HOME, CACHE_DIR)
+exts = set(ext for _, ext in ENCODERS.values())
+stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# entry name -> size, least recently used first
+entries: OrderedDict[str, int] = OrderedDict()
+# entry name -> staged renders using it that are not yet published
+pins: dict[str, int] = {}
+loaded = False
+total = 0
+lock = Lock()
+
+
+def load() -> None:
+    "load the cache index from disk ordered by last use"
+    global loaded, total
+    if loaded:
+        return
+    loaded = True
+    if not exists(cache_home):
+        makedirs(cache_home)
+    found = []
+    for name in listdir(cache_home):
+        (base, ext) = splitext(name)
+        if ext not in exts or base.endswith(".part"):
+            continue
+        st = stat(pjoin(cache_home, name))
+        found.append((st.st_mtime, name, st.st_size))
+    found.sort()
+    for _, name, size in found:
+        entries[name] = size
+        total += size
+    log.debug(f"render cache: {len(entries)} entries, {total} bytes")
+
+
+def cache_key(img: str, res: tuple[int, int], *extra) -> str:
+    """key a render by source identity, target size and render settings,
+    raising BadImage when the source is gone or unreadable"""
+    try:
+        st = stat(img)
+    except OSError as e:
+        raise BadImage(img, f"Unable to read {img}: {e}") from e
+    parts = [img, st.st_mtime_ns, st.st_size, res[0], res[1]]
+    parts += [SCALE_MAX, TOLERANCE, FLIP_FIRST, PYRAMID_GAP, *extra]
+    return sha1("|".join(str(p) for p in parts).encode(ENC)).hexdigest()
+
+
+def entry_path(key: str) -> str:
+    "path of the cache entry for a key"
+    return pjoin(cache_home, key + out_ext())
+
+
+def part_path(key: str) -> str:
+    "path to render a new cache entry into before it is stored"
+    return pjoin(cache_home, key + ".part" + out_ext())
+
+
+def fetch(key: str) -> str | None:
+    "return the cached render for key if present, counting hits and misses"
+    name = key + out_ext()
+    path = entry_path(key)
+    with lock:
+        load()
+        if name in entries and exists(path):
+            stats["hits"] += 1
+            entries.move_to_end(name)
+            pins[name] = pins.get(name, 0) + 1
+            utime(path)
+            log.debug(f"render cache hit: {name}")
+            return path
+        entries.pop(name, None)
+        stats["misses"] += 1
+    log.debug(f"render cache miss: {name}")
+    return None
+
+
+def pin(key: str) -> None:
+    "keep the entry for key, rendered or not yet, until it is released"
+    name = key + out_ext()
+    with lock:
+        pins[name] = pins.get(name, 0) + 1
+
+
+def release(paths: list[str]) -> None:
+    "entries published or no longer wanted may be evicted again"
+    with lock:
+        for path in paths:
+            name = basename(path)
+            count = pins.get(name, 0) - 1
+            if count > 0:
+                pins[name] = count
+            else:
+                pins.pop(name, None)
+        evict()
+
+
+def store(key: str) -> str:
+    "move a finished render from its part path into the cache"
+    global total
+    name = key + out_ext()
+    path = entry_path(key)
+    with lock:
+        load()
+        replace(part_path(key), path)
+        total -= entries.pop(name, 0)
+        entries[name] = stat(path).st_size
+        total += entries[name]
+        evict()
+    return path
+
+
+def evict() -> None:
+    """drop least recently used entries until under the cap, keeping
+    pinned ones, lock held"""
+    global total
+    for name in list(entries):
+        if total <= cache_max[0]:
+            break
+        if name in pins:
+            continue
+        size = entries.pop(name)
+        total -= size
+        stats["evictions"] += 1
+        try:
+            remove(pjoin(cache_home, name))
+        except FileNotFoundError:
+            pass
+        log.debug(f"render cache evict: {name}")
+
+
+def publish(src: str, dst: str) -> None:
+    "atomically place src at dst, hard linking when possible"
+    if exists(dst) and samefile(src, dst):
+        return
+    tmp = dst + ".tmp"
+    if exists(tmp):
+        remove(tmp)
+    place(src, tmp)
+    replace(tmp, dst)
+
+
+def place(src: str, dst: str) -> None:
+    """hard link src at dst, copying when links are not possible, only
+    for files that are replaced and never written to afterwards"""
+    if exists(dst):
+        # never write through an old file, it may share src's inode
+        remove(dst)
+    try:
+        link(src, dst)
+    except OSError:
+        copyfile(src, dst)
+
+
+def copy(src: str, dst: str) -> None:
+    "copy src over dst as a new file, leaving any old dst inode alone"
+    tmp = dst + ".tmp"
+    if exists(tmp):
+        remove(tmp)
+    copyfile(src, tmp)
+    replace(tmp, dst)
+
+
+def report() -> str:
+    "cache statistics as a log friendly string"
+    return (
+        f"render cache: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['evictions']} evictions, {len(entries)} entries, "
+        f"{total} bytes"
+    )
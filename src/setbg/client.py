@@ -0,0 +1,82 @@
+from argparse import ArgumentParser, Namespace
+from logging import getLogger
+from socket import AF_INET, SOCK_DGRAM, socket, timeout
+
+from os.path import expanduser, realpath
+
+from setbg.common import SetBGException
+
+from setbg.common import ENC, LG_LEVELS, LNAME
+from setbg.common import base_args, check_image, rsbg_image
+from setbg.rbgn import ADDRESS, MSG_SET, SET_WAIT
+
+DESC = "SetBG: A Background Setter"
+LOCAL = ["FILE", "log_level"]  # options that do not change the render
+
+log = getLogger(LNAME)
+
+
+def parse(parser: ArgumentParser) -> Namespace:
+    "parse the arguments, None if any would change how the image is made"
+    args = parser.parse_args()
+    if args.log_level:
+        log.setLevel(LG_LEVELS[args.log_level])
+    for key, value in vars(args).items():
+        if key not in LOCAL and value != parser.get_default(key):
+            log.debug(f"--{key} given, rendering in process")
+            return None
+    return args
+
+
+def submit(img: str) -> bool:
+    "ask a running RBG to show img, False if none is listening"
+    from json import loads
+
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.settimeout(SET_WAIT)
+    try:
+        sock.connect(ADDRESS)
+        sock.send((MSG_SET + img).encode(ENC))
+        reply = loads(sock.recv(4096).decode(ENC))
+    except ConnectionError:
+        # refused, or reset on Windows, when no RBG is listening
+        return False
+    except timeout:
+        raise SetBGException("No reply from RBG")
+    finally:
+        sock.close()
+    if "error" in reply:
+        raise SetBGException(reply["error"])
+    log.debug(f"shown by RBG: {reply['image']}")
+    return True
+
+
+def cli_setbg() -> None:
+    "SetBG through a running RBG, rendering in process without one"
+    try:
+        parser = base_args(DESC)
+        parser.add_argument("FILE", help="File to set on background")
+        args = parse(parser)
+        if args:
+            img = check_image(realpath(expanduser(args.FILE)), True)
+            if submit(img):
+                return
+    except SetBGException as e:
+        log.error(str(e))
+        return
+    from setbg.setbg import cli_setbg as setbg_here
+
+    setbg_here()
+
+
+def cli_rsbg() -> None:
+    "RSBG through a running RBG, rendering in process without one"
+    try:
+        if parse(base_args(DESC)) and submit(realpath(rsbg_image())):
+            return
+    except SetBGException as e:
+        log.error(str(e))
+        return
+    from setbg.setbg import cli_rsbg as rsbg_here
+
+    rsbg_here()
@@ -1,44 +1,92 @@
-from argparse import ArgumentParser, Namespace
+from argparse import SUPPRESS, Action, ArgumentParser, Namespace
 
 from logging import INFO, WARNING, DEBUG
 from os import devnull
 
 from glob import glob
-from importlib.metadata import version
 from logging import basicConfig, getLogger
-from mimetypes import guess_type
+from functools import cache
 from os import mkdir
-from os.path import expanduser, exists, isdir, isfile, realpath
+from os.path import expanduser, exists, isdir, isfile, realpath, splitext
+from os.path import join as pjoin
 from platform import system
-from screeninfo import get_monitors
-from shutil import which
-from subprocess import check_output
 
 # constants
 BG_HOME = expanduser("~/.bg")  # directory to store computed images
 BG_NAME = "bg.jpg"  # name of computed image
-BG_SWITCH = ["bg-a.jpg", "bg-b.jpg"]
-BOUNCE = 0.25  # bounce time for directory scans
+BG_SWITCH = ["-a", "-b"]  # suffixes of the links the WM is pointed at
+CACHE_DIR = "cache"  # render cache directory under BG_HOME
+CACHE_MAX = 512  # default render cache size cap in MiB (0 disables)
+COMPOSITE = "fast"  # default tile compositing engine
+COMPOSITE_MODES = ["fast", "numpy", "paste"]  # block, array, per tile
+DECODE = "quality"  # default JPEG decode mode
+DECODE_MODES = {
+    "full": 0,  # decode every pixel then resample
+    "quality": 2,  # decode at no less than twice the target size
+    "speed": 1,  # decode at no less than the target size
+}
 D_EXCLUDE = set(
     [".thumbnails", "@eaDir"]
 )  # directories to exclude from search
 ENC = "utf-8"  # default encoding
+ENCODE = "jpeg"  # default output format
+ENCODERS = {  # output format: Pillow format and file extension
+    "bmp": ("BMP", ".bmp"),  # uncompressed, fastest to write
+    "jpeg": ("JPEG", ".jpg"),
+    "png": ("PNG", ".png"),
+}
 FLIP_FIRST = False  # Flip first image in tiling operation
+INDEX_NAME = "index.db"  # scan index database in BG_HOME
 LG_FORMAT = "%(levelname)s:%(name)s:%(message)s"  # default log format
 LG_LEVEL = "warning"  # default log level
 LG_LEVELS = {"info": INFO, "warning": WARNING, "debug": DEBUG}
 LNAME = "SetBG"  # logger name
+MANIFEST_NAME = ".setbg-manifest.json"  # tree sync manifest in tree root
+METRICS_NAME = "metrics.jsonl"  # per change timings file in BG_HOME
+METRICS_WINDOW = 200  # changes kept for timing percentiles
+MONITOR_WORKERS = 4  # threads rendering monitors in parallel
+PIXEL_MAX = 100  # default decoded pixel budget in megapixels (0 disables)
+POLL_RATE = 200  # default directories polled a second, 0 for no limit
+PREFETCH = 2  # number of upcoming images to render ahead in RBG
+PROFILE_NAME = "profile-{}.txt"  # profiling report in BG_HOME per program
+PROFILE_SAMPLE = 0.1  # seconds between memory checks while profiling
+PROFILE_TOP = 30  # functions and allocation sites listed when profiling
+PYRAMID_GAP = 3  # smallest ratio from a halved source level to a scaled size
+QUALITY = 75  # default JPEG quality
+QUARANTINE_NAME = "quarantine.txt"  # report of bad images in BG_HOME
 RESOLUTION = "1920x1080"  # default resolution
-RSBG_IMG = glob(expanduser("~/Documents/RSBG.*"))[0]  # default image to use
+RSBG_GLOB = "~/Documents/RSBG.*"  # default image to use
 SCALE_MAX = 2  # maximum scale factor for images
+SCAN_WORKERS = 8  # threads listing directories concurrently
 SLEEP = 300  # default sleep time
+STAGE_DIR = "stage"  # directory under BG_HOME for uncached staged renders
+SUBSAMPLING = ["4:4:4", "4:2:2", "4:2:0"]  # JPEG chroma subsampling
 WM_NAME = 'wmctrl -m | grep Name | cut -f 2 -d " "'  # Get WM name
+XFCONF_REFRESH = 600  # seconds before rereading xfce desktop properties
+VALIDATE_BATCH = 50  # header checks between pauses of the validator
+VALIDATE_PAUSE = 0.05  # seconds the validator yields after each batch
+VALIDATE_SETTLE = 2.0  # seconds unmodified before a new file is checked
+TILE_BLOCK = 256  # pixels a side of the block fast tiles with
+TILE_PASTE = 12  # fast pastes tile by tile up to this many tiles
 TOLERANCE = 10  # pixels tolerance for resolution matching
 TREE_UMASK = 0o022  # umask for created directories
 
 # globals
+cache_max: list[int] = [CACHE_MAX * 2**20]  # render cache cap in bytes
+composite: list[str] = [COMPOSITE]  # tile compositing engine
+decode_mode: list[str] = [DECODE]  # JPEG decode mode
+metrics_file: list[str] = [""]  # append stage timings here when set
+metrics_on: list[bool] = [False]  # time render and switch stages
+monitors: list[tuple[str, int, int]] = []  # name, width, height per monitor
+per_monitor: list[bool] = [False]  # render each monitor at its own size
+pixel_max: list[int] = [PIXEL_MAX * 10**6]  # largest decode in pixels
+profile_on: list[bool] = [False]  # profile CPU and memory until exit
+optimize: list[bool] = [False]  # extra encoder pass for smaller files
+out_format: list[str] = [ENCODE]  # output format
+quality: list[int] = [QUALITY]  # JPEG quality
 r: list[int] = [0, 0]  # resolution
 res_set = False  # has the resolution been set?
+subsampling: list[str] = [""]  # JPEG chroma subsampling, "" for default
 system_name = system()  # system name
 w = h = 2**20  # default to a large value
 window_manager: list[str] = []  # window manager name
@@ -54,29 +102,110 @@ class SetBGException(Exception):
     pass
 
 
+class ImageError(SetBGException):
+    """A source image that cannot be shown."""
+
+    def __init__(self, image: str, message: str) -> None:
+        super().__init__(message)
+        self.image = image
+
+
+class BadImage(ImageError):
+    """An image that cannot be decoded."""
+
+    pass
+
+
+class ImageTooLarge(ImageError):
+    """An image would decode to more pixels than the budget allows."""
+
+    pass
+
+
 def check_image(image: str, check_exists=False) -> str:
     "check image exists and is an image"
     image = realpath(expanduser(image))
     if check_exists:
         if not isfile(image):
             raise SetBGException(f"{image} does not exist")
-    mt = guess_type(image)
-    if mt[0] and mt[0].startswith("image"):
-        pass
-    else:
+    if not is_image_name(image):
         raise SetBGException(f"{image} not an image")
     return image
 
 
+def is_image_name(name: str) -> bool:
+    "does the file name have an image extension"
+    return is_image_ext(splitext(name)[1])
+
+
+@cache
+def is_image_ext(ext: str) -> bool:
+    "is the extension an image type, looked up once per extension"
+    from mimetypes import guess_type
+
+    mt = guess_type("x" + ext)
+    return bool(mt[0] and mt[0].startswith("image"))
+
+
+def out_ext() -> str:
+    "file extension of the selected output format"
+    return ENCODERS[out_format[0]][1]
+
+
+def encoding() -> tuple:
+    "output settings that change the bytes of a render"
+    return (out_format[0], quality[0], subsampling[0], optimize[0])
+
+
+def render_settings() -> tuple:
+    "every option a render reads, to hand to worker processes"
+    return (
+        composite[0],
+        decode_mode[0],
+        pixel_max[0],
+        *encoding(),
+        log.level,
+    )
+
+
+def use_render_settings(settings: tuple) -> None:
+    "apply render_settings() from the parent in a worker process"
+    (
+        composite[0],
+        decode_mode[0],
+        pixel_max[0],
+        out_format[0],
+        quality[0],
+        subsampling[0],
+        optimize[0],
+        level,
+    ) = settings
+    log.setLevel(level)
+
+
+@cache
+def rsbg_image() -> str:
+    "the default image, found on first use"
+    found = glob(expanduser(RSBG_GLOB))
+    if not found:
+        raise SetBGException(f"No default image {RSBG_GLOB}")
+    return check_image(found[0])
+
+
 def check_env() -> None:
     "check the environment is setup"
-    global window_manager, RSBG_IMG
+    from shutil import which
+    from subprocess import check_output
+
+    global window_manager
     if not exists(BG_HOME):
         mkdir(BG_HOME)
     else:
         if not isdir(BG_HOME):
             raise SetBGException(f"{BG_HOME} not a directory")
-    RSBG_IMG = check_image(RSBG_IMG)
+    if not exists(pjoin(BG_HOME, STAGE_DIR)):
+        mkdir(pjoin(BG_HOME, STAGE_DIR))
+    rsbg_image()
     log.debug(f"System name: {system_name}")
     if system_name == "Linux":
         if not which("wmctrl"):
@@ -89,17 +218,20 @@ def check_env() -> None:
 
 def get_resolution(res: str) -> None:
     "get the system resolution"
+    from screeninfo import get_monitors
+
     global res_set, w, h, r
     if res_set:
         return
     res_set = True
     for m in get_monitors():
+        monitors.append((m.name or "", m.width, m.height))
         if m.width < w:
             w = m.width
         if m.height < h:
             h = m.height
     if w == 2**20 or h == 2**20:
-        (wd, hd) = res.split("x")
+        (wd, hd) = (res or RESOLUTION).split("x")
         w = int(wd)
         h = int(hd)
         log.warning("Unable to determine screen resolution, using default")
@@ -108,6 +240,20 @@ def get_resolution(res: str) -> None:
     log.debug(f"screen resolution {r[0]}x{r[1]}")
 
 
+class VersionAction(Action):
+    "print the version, reading package metadata only when asked"
+
+    def __init__(self, option_strings, dest=SUPPRESS, help=None):
+        super().__init__(
+            option_strings, dest, default=SUPPRESS, nargs=0, help=help
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import version
+
+        parser.exit(message=version("setbg") + "\n")
+
+
 def base_args(desc: str, size=True) -> ArgumentParser:
     "standard arguments for SetBG and RSBG"
     parser = ArgumentParser(description=desc)
@@ -117,11 +263,85 @@ def base_args(desc: str, size=True) -> ArgumentParser:
             "--size",
             help="Overide screen size use WIDTHxHEIGHT (e.g. 1920x1080)",
         )
+        parser.add_argument(
+            "-C",
+            "--cache-size",
+            type=int,
+            default=CACHE_MAX,
+            help=f"Render cache size in MiB, 0 disables (default {CACHE_MAX})",
+        )
+        parser.add_argument(
+            "-M",
+            "--metrics",
+            action="store_true",
+            help="Time each render and switch stage",
+        )
+        parser.add_argument(
+            "--metrics-file",
+            action="store_true",
+            help=f"Also append stage timings to {METRICS_NAME} in {BG_HOME}",
+        )
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="Profile CPU and memory, writing "
+            f"{PROFILE_NAME.format('NAME')} in {BG_HOME} on exit",
+        )
+        parser.add_argument(
+            "--per-monitor",
+            action="store_true",
+            help="Render for each monitor at its own resolution",
+        )
+        parser.add_argument(
+            "--composite",
+            choices=COMPOSITE_MODES,
+            default=COMPOSITE,
+            help=f"Tile compositing engine default ({COMPOSITE}): "
+            + ", ".join(COMPOSITE_MODES),
+        )
+        parser.add_argument(
+            "-E",
+            "--encode",
+            choices=ENCODERS,
+            default=ENCODE,
+            help=f"Output format default ({ENCODE}): " + ", ".join(ENCODERS),
+        )
+        parser.add_argument(
+            "-Q",
+            "--quality",
+            type=int,
+            default=QUALITY,
+            help=f"JPEG output quality (default {QUALITY})",
+        )
+        parser.add_argument(
+            "--subsampling",
+            choices=SUBSAMPLING,
+            help="JPEG output chroma subsampling (default Pillow's)",
+        )
+        parser.add_argument(
+            "--optimize",
+            action="store_true",
+            help="Spend longer encoding for smaller output files",
+        )
+        parser.add_argument(
+            "--max-pixels",
+            type=int,
+            default=PIXEL_MAX,
+            help="Skip images that would decode to more megapixels "
+            f"(default {PIXEL_MAX}, 0 disables)",
+        )
+        parser.add_argument(
+            "-D",
+            "--decode",
+            choices=DECODE_MODES,
+            default=DECODE,
+            help=f"JPEG decode mode default ({DECODE}): "
+            + ", ".join(DECODE_MODES),
+        )
     parser.add_argument(
         "--version",
-        action="version",
+        action=VersionAction,
         help="show version number",
-        version=version("setbg"),
     )
     parser.add_argument(
         "-L",
@@ -141,6 +361,24 @@ def base_arg_handler(parser: ArgumentParser, size=True) -> Namespace:
         log.setLevel(LG_LEVELS[args.log_level])
     log.debug(f"Arguments: {args}")
     if size:
+        cache_max[0] = args.cache_size * 2**20
+        if args.composite == "numpy":
+            from importlib.util import find_spec
+
+            if find_spec("numpy") is None:
+                raise SetBGException("numpy not installed, needed for numpy")
+        composite[0] = args.composite
+        decode_mode[0] = args.decode
+        out_format[0] = args.encode
+        quality[0] = args.quality
+        subsampling[0] = args.subsampling or ""
+        optimize[0] = args.optimize
+        per_monitor[0] = args.per_monitor
+        pixel_max[0] = args.max_pixels * 10**6
+        metrics_on[0] = args.metrics or args.metrics_file
+        if args.metrics_file:
+            metrics_file[0] = pjoin(BG_HOME, METRICS_NAME)
+        profile_on[0] = args.profile
         if args.size:
             res_set = True
             r[0] = int(args.size.split("x")[0])
@@ -0,0 +1,124 @@
+from hashlib import file_digest
+from logging import getLogger
+from os import stat
+from time import time
+from typing import Self
+
+from setbg.common import LNAME, VALIDATE_SETTLE
+from setbg.index import ScanIndex
+
+log = getLogger(LNAME)
+
+
+class Dedup:
+    "Find files with identical content, hashing only same sized files"
+
+    def __init__(self: Self, index: ScanIndex | None = None) -> None:
+        "digests are kept in index when given"
+        self.index = index
+        self.reset()
+
+    def reset(self: Self) -> None:
+        "forget every file seen so far"
+        self.sizes: dict[int, list[str]] = {}  # size -> paths in order seen
+        self.seen: dict[str, tuple[int, int]] = {}  # path -> size, mtime
+        self.digests: dict[str, str] = {}  # path -> content digest
+        self.first: dict[str, str] = {}  # digest -> the copy that is kept
+        self.held: list[str] = []  # still being written at the last unique
+        self.stats = {"hashed": 0, "reused": 0}
+
+    def unique(self: Self, paths: list[str]) -> list[str]:
+        """paths without copies of files seen before, the first copy kept,
+        files modified in the last VALIDATE_SETTLE seconds are kept
+        unhashed and listed in held to be checked again"""
+        pending: set[int] = set()
+        self.held = []
+        for fp in sorted(paths):
+            try:
+                st = stat(fp)
+            except OSError:
+                continue
+            state = (st.st_size, st.st_mtime_ns)
+            if self.seen.get(fp, state) != state:
+                self.forget(fp)
+            if time() - st.st_mtime < VALIDATE_SETTLE:
+                self.held.append(fp)
+                continue
+            group = self.sizes.setdefault(st.st_size, [])
+            if fp not in group:
+                group.append(fp)
+                self.seen[fp] = state
+            if len(group) > 1:
+                pending.add(st.st_size)
+        for size in pending:
+            for fp in self.sizes[size]:
+                if fp not in self.digests:
+                    self.add(fp)
+        if self.index:
+            self.index.commit()
+        return [
+            fp
+            for fp in paths
+            if fp not in self.digests
+            or self.first[self.digests[fp]] == fp
+        ]
+
+    def add(self: Self, fp: str) -> None:
+        "hash a file, reusing the indexed digest when it is unchanged"
+        try:
+            st = stat(fp)
+            if (st.st_size, st.st_mtime_ns) != self.seen[fp]:
+                # written since it was grouped, look again once settled
+                self.held.append(fp)
+                return
+            digest = None
+            if self.index:
+                digest = self.index.digest(fp, st.st_size, st.st_mtime_ns)
+            if digest:
+                self.stats["reused"] += 1
+            else:
+                with open(fp, "rb") as file:
+                    digest = file_digest(file, "sha1").hexdigest()
+                self.stats["hashed"] += 1
+                if self.index:
+                    self.index.store_digest(
+                        fp, st.st_size, st.st_mtime_ns, digest
+                    )
+        except OSError as e:
+            log.warning(f"Unable to hash {fp}: {e}")
+            return
+        self.digests[fp] = digest
+        if self.first.setdefault(digest, fp) != fp:
+            log.debug(f"duplicate of {self.first[digest]}: {fp}")
+
+    def changed(self: Self, paths: list[str]) -> list[str]:
+        "the paths seen before whose size or mtime is not the same now"
+        stale = []
+        for fp in paths:
+            if fp not in self.seen:
+                continue
+            try:
+                st = stat(fp)
+            except OSError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != self.seen[fp]:
+                stale.append(fp)
+        return stale
+
+    def forget(self: Self, fp: str) -> str | None:
+        """drop a file that is gone or changed, returning the copy now kept
+        instead"""
+        state = self.seen.pop(fp, None)
+        if state is None:
+            return None
+        size = state[0]
+        self.sizes[size].remove(fp)
+        digest = self.digests.pop(fp, None)
+        if not digest or self.first.get(digest) != fp:
+            return None
+        del self.first[digest]
+        for other in self.sizes[size]:
+            if self.digests.get(other) == digest:
+                self.first[digest] = other
+                return other
+        return None
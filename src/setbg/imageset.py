@@ -0,0 +1,149 @@
+from collections.abc import Iterable
+from hashlib import sha1
+from heapq import heappush, heapreplace
+from random import getrandbits, randint, sample, shuffle
+from threading import RLock
+from typing import Self
+
+from setbg.common import ENC
+
+RECENT = 16  # images from the end of a lap kept out of the next lap start
+
+
+class ImageSet:
+    "Shuffled image rotation with O(1) add and remove"
+
+    def __init__(self: Self) -> None:
+        "empty rotation, images before index have been shown this lap"
+        self.lock = RLock()
+        self.images: list[str] = []
+        self.positions: dict[str, int] = {}
+        self.index = 0
+
+    def __len__(self: Self) -> int:
+        "number of images in the rotation"
+        return len(self.images)
+
+    def __contains__(self: Self, fp: object) -> bool:
+        "is the image in the rotation"
+        return fp in self.positions
+
+    def clear(self: Self) -> None:
+        "drop every image and restart the lap"
+        with self.lock:
+            self.images = []
+            self.positions = {}
+            self.index = 0
+
+    def extend(self: Self, fps: Iterable[str]) -> None:
+        "add many images then shuffle the part not yet shown"
+        with self.lock:
+            for fp in fps:
+                if fp not in self.positions:
+                    self.positions[fp] = len(self.images)
+                    self.images.append(fp)
+            unshown = self.images[self.index :]
+            shuffle(unshown)
+            self.images[self.index :] = unshown
+            for i in range(self.index, len(self.images)):
+                self.positions[self.images[i]] = i
+
+    def move(self: Self, src: int, dst: int) -> None:
+        "move the image at src to dst"
+        self.images[dst] = self.images[src]
+        self.positions[self.images[dst]] = dst
+
+    def swap(self: Self, a: int, b: int) -> None:
+        "swap two images"
+        fa = self.images[a]
+        self.move(b, a)
+        self.images[b] = fa
+        self.positions[fa] = b
+
+    def add(self: Self, fp: str) -> bool:
+        "add an image at a random point in the part not yet shown"
+        with self.lock:
+            if fp in self.positions:
+                return False
+            self.images.append(fp)
+            last = len(self.images) - 1
+            self.positions[fp] = last
+            self.swap(randint(min(self.index, last), last), last)
+            return True
+
+    def remove(self: Self, fp: str) -> bool:
+        "remove an image keeping the shown and unshown parts intact"
+        with self.lock:
+            pos = self.positions.pop(fp, None)
+            if pos is None:
+                return False
+            hole = pos
+            if pos < self.index:
+                # fill from the last shown image so the cursor stays put
+                hole = self.index - 1
+                if hole != pos:
+                    self.move(hole, pos)
+                self.index -= 1
+            last = len(self.images) - 1
+            if hole != last:
+                self.move(last, hole)
+            self.images.pop()
+            return True
+
+    def new_lap(self: Self) -> None:
+        "reshuffle keeping the end of the last lap away from the start"
+        n = len(self.images)
+        recent = min(RECENT, n // 2)
+        tail = set(self.images[n - recent :])
+        shuffle(self.images)
+        for i in range(n):
+            self.positions[self.images[i]] = i
+        for i in range(recent):
+            while self.images[i] in tail:
+                self.swap(i, randint(recent, n - 1))
+        self.index = 0
+
+    def next(self: Self) -> str | None:
+        "next image in the rotation, None if empty"
+        with self.lock:
+            if not self.images:
+                return None
+            if self.index >= len(self.images):
+                self.new_lap()
+            self.index += 1
+            return self.images[self.index - 1]
+
+    def peek(self: Self, count: int) -> list[str]:
+        "the next count images of this lap without advancing"
+        with self.lock:
+            return self.images[self.index : self.index + count]
+
+    def sample(self: Self, limit: int) -> list[str]:
+        "a random selection of up to limit images, all when limit is 0"
+        with self.lock:
+            if limit <= 0 or limit >= len(self.images):
+                return list(self.images)
+            return sample(self.images, limit)
+
+
+def sample_key(item: str, seed: str | None) -> int:
+    "random sort key for an item, a hash of item and seed when seeded"
+    if seed is None:
+        return getrandbits(64)
+    digest = sha1(f"{seed}\0{item}".encode(ENC, "surrogateescape")).digest()
+    return int.from_bytes(digest[:8])
+
+
+def sample_stream(
+    items: Iterable[str], limit: int, seed: str | None = None
+) -> list[str]:
+    """uniform sample of up to limit items in one pass holding at most
+    limit of them, the same items always give the same sample when seeded"""
+    heap: list[tuple[int, str]] = []  # negated keys, largest key on top
+    for item in items:
+        key = -sample_key(item, seed)
+        if len(heap) < limit:
+            heappush(heap, (key, item))
+        elif key > heap[0][0]:
+            heapreplace(heap, (key, item))
+    return [item for _, item in sorted(heap, reverse=True)]
@@ -0,0 +1,216 @@
+from logging import getLogger
+from collections.abc import Iterator
+from os import stat
+from sqlite3 import connect
+from threading import Lock
+from typing import Self
+
+from os.path import join as pjoin
+
+from setbg.common import BG_HOME, INDEX_NAME, LNAME
+from setbg.scan import list_dir, walk_trees
+
+log = getLogger(LNAME)
+
+SEP = "\0"  # separator for names stored in one column
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL,
+    images TEXT NOT NULL
+)
+"""
+
+HASH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+)
+"""
+
+PROBE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    error TEXT NOT NULL
+)
+"""
+
+FILE_TABLES = ["hashes", "probes"]  # per file tables pruned with dirs
+
+
+def split(value: str) -> list[str]:
+    "split a stored name list"
+    return value.split(SEP) if value else []
+
+
+class ScanIndex:
+    "Persistent per directory scan results keyed by directory mtime"
+
+    def __init__(self: Self, rescan=False, path="") -> None:
+        "open the index, dropping it first when a full rescan is asked for"
+        self.path = path or pjoin(BG_HOME, INDEX_NAME)
+        self.lock = Lock()
+        self.db = connect(self.path, check_same_thread=False)
+        self.db.execute(SCHEMA)
+        self.db.execute(HASH_SCHEMA)
+        self.db.execute(PROBE_SCHEMA)
+        if rescan:
+            log.info("Rebuilding scan index")
+            self.db.execute("DELETE FROM dirs")
+        self.db.commit()
+        self.stats = {"reused": 0, "scanned": 0}
+
+    def scan_dir(self: Self, dir: str) -> tuple[list[str], list[str]]:
+        "list a directory, reusing the stored listing if its mtime is same"
+        mtime = stat(dir).st_mtime_ns
+        with self.lock:
+            row = self.db.execute(
+                "SELECT mtime_ns, subdirs, images FROM dirs WHERE path = ?",
+                (dir,),
+            ).fetchone()
+        if row and row[0] == mtime:
+            self.stats["reused"] += 1
+            return split(row[1]), split(row[2])
+        self.stats["scanned"] += 1
+        subdirs, imgs = list_dir(dir)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                (dir, mtime, SEP.join(subdirs), SEP.join(imgs)),
+            )
+        return subdirs, imgs
+
+    def walk(self: Self, roots: list[str]) -> Iterator[tuple[str, list[str]]]:
+        "walk roots yielding (directory, images), relisting changed ones"
+        self.stats = {"reused": 0, "scanned": 0}
+        seen: set[str] = set()
+        for dir, imgs in walk_trees(roots, self.scan_dir):
+            seen.add(dir)
+            yield dir, imgs
+        for root in roots:
+            self.prune(root, seen)
+        self.commit()
+        log.info(
+            f"scan index {', '.join(roots)}: {self.stats['reused']} reused, "
+            f"{self.stats['scanned']} scanned"
+        )
+
+    def prune(self: Self, root: str, seen: set[str]) -> list[str]:
+        """forget directories under root that no longer exist, returning
+        the images they held"""
+        prefix = root.rstrip("/") + "/"
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path, images FROM dirs"
+                " WHERE path = ? OR substr(path, 1, ?) = ?",
+                (root, len(prefix), prefix),
+            ).fetchall()
+            gone = [(p,) for (p, _) in rows if p not in seen]
+            if gone:
+                self.db.executemany("DELETE FROM dirs WHERE path = ?", gone)
+                for table in FILE_TABLES:
+                    self.db.executemany(
+                        f"DELETE FROM {table}"
+                        " WHERE substr(path, 1, length(?) + 1) = ? || '/'",
+                        [(p, p) for (p,) in gone],
+                    )
+                log.debug(f"scan index dropped {len(gone)} directories")
+        return [
+            fp for (p, imgs) in rows if p not in seen for fp in split(imgs)
+        ]
+
+    def dirs(self: Self, roots: list[str]) -> list[tuple[str, int]]:
+        "(path, mtime) of the indexed directories under roots, parents first"
+        found: list[tuple[str, int]] = []
+        with self.lock:
+            for root in roots:
+                prefix = root.rstrip("/") + "/"
+                found += self.db.execute(
+                    "SELECT path, mtime_ns FROM dirs"
+                    " WHERE path = ? OR substr(path, 1, ?) = ?"
+                    " ORDER BY path",
+                    (root, len(prefix), prefix),
+                ).fetchall()
+        return found
+
+    def listing(self: Self, dir: str) -> tuple[list[str], list[str]]:
+        "stored (subdirectories, images) of a directory, empty if unknown"
+        with self.lock:
+            row = self.db.execute(
+                "SELECT subdirs, images FROM dirs WHERE path = ?", (dir,)
+            ).fetchone()
+        if not row:
+            return [], []
+        return split(row[0]), split(row[1])
+
+    def digest(self: Self, path: str, size: int, mtime: int) -> str | None:
+        "stored content digest of a file, None if unknown or changed"
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, digest FROM hashes WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if row and row[0] == size and row[1] == mtime:
+            return row[2]
+        return None
+
+    def store_digest(
+        self: Self, path: str, size: int, mtime: int, digest: str
+    ) -> None:
+        "remember the content digest of a file"
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                (path, size, mtime, digest),
+            )
+
+    def probed(self: Self, path: str, size: int, mtime: int) -> str | None:
+        "stored header check error of a file, None if unknown or changed"
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, error FROM probes WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if row and row[0] == size and row[1] == mtime:
+            return row[2]
+        return None
+
+    def store_probe(
+        self: Self, path: str, size: int, mtime: int, header: tuple
+    ) -> None:
+        "remember the header check, (format, width, height, mode, error)"
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO probes"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, size, mtime, *header),
+            )
+
+    def quarantined(self: Self) -> list[tuple[str, str]]:
+        "(path, error) of every file that failed its header check"
+        with self.lock:
+            return self.db.execute(
+                "SELECT path, error FROM probes WHERE error != ''"
+                " ORDER BY path"
+            ).fetchall()
+
+    def commit(self: Self) -> None:
+        "write pending changes"
+        with self.lock:
+            self.db.commit()
+
+    def close(self: Self) -> None:
+        "close the database"
+        with self.lock:
+            self.db.commit()
+            self.db.close()
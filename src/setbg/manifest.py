@@ -0,0 +1,81 @@
+from json import dump, load
+from logging import getLogger
+from os import remove, replace, rmdir
+from pathlib import Path
+from typing import Self
+
+from os.path import sep
+
+from setbg.common import ENC, LNAME, MANIFEST_NAME
+
+log = getLogger(LNAME)
+
+
+class Manifest:
+    "What each generated tree file was rendered from, to sync trees"
+
+    def __init__(self: Self, tree: Path) -> None:
+        "load the manifest of a tree, empty if it has none yet"
+        self.tree = tree
+        self.path = tree / MANIFEST_NAME
+        # output relative to the tree -> [source, render key]
+        self.outputs: dict[str, list[str]] = {}
+        if self.path.exists():
+            with self.path.open("r", encoding=ENC) as fp:
+                self.outputs = load(fp)
+        self.planned: dict[str, list[str]] = {}
+        self.stats = {"kept": 0, "rendered": 0, "removed": 0}
+
+    def picked(self: Self, dir: str) -> set[str]:
+        "sources under dir that the tree was generated from"
+        prefix = dir.rstrip(sep) + sep
+        return set(
+            src for src, _ in self.outputs.values() if src.startswith(prefix)
+        )
+
+    def plan(self: Self, dst: str, src: str, key: str) -> bool:
+        "note dst is wanted, True if it has to be rendered"
+        rel = str(Path(dst).relative_to(self.tree))
+        self.planned[rel] = [src, key]
+        if self.outputs.get(rel) == [src, key] and Path(dst).exists():
+            self.stats["kept"] += 1
+            return False
+        self.stats["rendered"] += 1
+        return True
+
+    def commit(self: Self, failed: set[str]) -> None:
+        "remove outputs no longer wanted and save what was rendered"
+        for rel in set(self.outputs) - set(self.planned):
+            self.remove(rel)
+        for rel in list(self.planned):
+            if str(self.tree / rel) in failed:
+                del self.planned[rel]
+        self.outputs = self.planned
+        self.planned = {}
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w", encoding=ENC) as fp:
+            dump(self.outputs, fp)
+        replace(tmp, self.path)
+        log.info(
+            f"tree sync {self.tree}: {self.stats['kept']} kept, "
+            f"{self.stats['rendered']} rendered, "
+            f"{self.stats['removed']} removed"
+        )
+
+    def remove(self: Self, rel: str) -> None:
+        "delete an output and any directories it leaves empty"
+        dst = self.tree / rel
+        try:
+            remove(dst)
+        except FileNotFoundError:
+            pass
+        self.stats["removed"] += 1
+        log.debug(f"removed from tree: {dst}")
+        parent = dst.parent
+        while (
+            parent != self.tree
+            and parent.is_dir()
+            and not any(parent.iterdir())
+        ):
+            rmdir(parent)
+            parent = parent.parent
@@ -0,0 +1,93 @@
+from collections import deque
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from json import dumps
+from logging import getLogger
+from threading import Lock, local
+from time import perf_counter, time
+
+from setbg.common import ENC, LNAME, METRICS_WINDOW
+from setbg.common import metrics_file, metrics_on
+
+log = getLogger(LNAME)
+
+NULL = nullcontext()
+
+records = local()  # per thread record being filled in
+windows: dict[str, deque[float]] = {}  # recent durations per stage
+last: dict[str, dict] = {}  # last finished record per event
+lock = Lock()
+
+
+def begin(event: str, **fields) -> None:
+    "start a record for this thread"
+    if metrics_on[0]:
+        records.current = {"event": event, "time": time(), **fields}
+
+
+def note(**fields) -> None:
+    "add fields to this thread's record"
+    record = getattr(records, "current", None)
+    if record is not None:
+        record.update(fields)
+
+
+@contextmanager
+def timed(record: dict, name: str):
+    "time a block into the record"
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record[name] = perf_counter() - start
+
+
+def stage(name: str) -> AbstractContextManager:
+    "context timing a stage, a shared no-op when nothing is recording"
+    record = getattr(records, "current", None)
+    if record is None:
+        return NULL
+    return timed(record, name)
+
+
+def end() -> None:
+    "finish this thread's record, keep its timings and write it out"
+    record = getattr(records, "current", None)
+    if record is None:
+        return
+    records.current = None
+    with lock:
+        last[record["event"]] = record
+        for name, value in record.items():
+            if isinstance(value, float) and name != "time":
+                if name not in windows:
+                    windows[name] = deque(maxlen=METRICS_WINDOW)
+                windows[name].append(value)
+        if metrics_file[0]:
+            with open(metrics_file[0], "a", encoding=ENC) as fp:
+                fp.write(dumps(record) + "\n")
+
+
+def percentile(values: list[float], pct: float) -> float:
+    "nearest rank percentile of sorted values"
+    return values[min(len(values) - 1, int(pct / 100 * len(values)))]
+
+
+def percentiles() -> dict[str, dict[str, float]]:
+    "p50, p90 and p99 of the recent durations of each stage"
+    with lock:
+        snapshot = {name: sorted(w) for name, w in windows.items()}
+    return {
+        name: {f"p{p}": percentile(v, p) for p in (50, 90, 99)}
+        for name, v in snapshot.items()
+        if v
+    }
+
+
+def report() -> str:
+    "stage percentiles in milliseconds as a log friendly string"
+    parts = [
+        f"{name} {p['p50'] * 1000:.1f}/{p['p90'] * 1000:.1f}"
+        f"/{p['p99'] * 1000:.1f}"
+        for name, p in percentiles().items()
+    ]
+    return "timings ms p50/p90/p99: " + ", ".join(parts)
@@ -0,0 +1,117 @@
+from collections.abc import Callable
+from logging import getLogger
+from os import stat
+from threading import Thread
+from time import monotonic, sleep
+from typing import Self
+
+from setbg.common import LNAME, POLL_RATE
+from setbg.index import ScanIndex
+
+log = getLogger(LNAME)
+
+Change = Callable[[list[str], list[str]], None]  # added, gone images
+
+
+class Poller:
+    "Find tree changes by comparing directory mtimes with the scan index"
+
+    def __init__(
+        self: Self,
+        index: ScanIndex,
+        roots: list[str],
+        interval: float,
+        on_change: Change,
+        rate: int = POLL_RATE,
+    ) -> None:
+        """poll roots every interval seconds, stating at most rate
+        directories a second, and report changes to on_change"""
+        self.index = index
+        self.roots = roots
+        self.interval = interval
+        self.on_change = on_change
+        self.rate = rate
+        self.stats: dict = {"passes": 0, "dirs": 0, "changed": 0}
+        self.stats.update(added=0, gone=0, seconds=0.0)
+        self.running = True
+
+    def run(self: Self, after: Thread | None = None) -> None:
+        "poll until stopped, once the first scan in after has finished"
+        if after:
+            after.join()
+        while self.running:
+            sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                log.warning(f"Poll failed: {e}")
+
+    def poll(self: Self) -> None:
+        "stat every indexed directory and relist only those that changed"
+        start = monotonic()
+        ops = 0
+        stats = {"dirs": 0, "changed": 0}
+        added: list[str] = []
+        gone: list[str] = []
+        for dir, mtime in self.index.dirs(self.roots):
+            ops += 1
+            self.throttle(start, ops)
+            try:
+                now = stat(dir).st_mtime_ns
+            except FileNotFoundError:
+                # dropped with its parent, which changed too
+                continue
+            except OSError as e:
+                log.warning(f"Unable to poll {dir}: {e}")
+                continue
+            stats["dirs"] += 1
+            if now == mtime:
+                continue
+            ops += 1
+            self.throttle(start, ops)
+            stats["changed"] += 1
+            self.relist(dir, added, gone)
+        self.index.commit()
+        # every pass, quarantined files may have been rewritten in place
+        self.on_change(added, gone)
+        self.stats.update(stats, added=len(added), gone=len(gone))
+        self.stats["passes"] += 1
+        self.stats["seconds"] = round(monotonic() - start, 3)
+        log.info(f"poll: {self.report()}")
+
+    def relist(
+        self: Self, dir: str, added: list[str], gone: list[str]
+    ) -> None:
+        "list a changed directory again, noting what came and went"
+        (old_subdirs, old_imgs) = self.index.listing(dir)
+        try:
+            (subdirs, imgs) = self.index.scan_dir(dir)
+        except OSError as e:
+            log.warning(f"Unable to relist {dir}: {e}")
+            return
+        for sd in set(old_subdirs) - set(subdirs):
+            gone += self.index.prune(sd, set())
+        old = set(old_imgs)
+        now = set(imgs)
+        gone += [fp for fp in old_imgs if fp not in now]
+        added += [fp for fp in imgs if fp not in old]
+        new = list(set(subdirs) - set(old_subdirs))
+        if new:
+            for _, found in self.index.walk(new):
+                added += found
+
+    def throttle(self: Self, start: float, ops: int) -> None:
+        "sleep to keep the pass under rate directory operations a second"
+        if not self.rate:
+            return
+        ahead = start + ops / self.rate - monotonic()
+        if ahead > 0:
+            sleep(ahead)
+
+    def report(self: Self) -> str:
+        "summary of the last pass"
+        return (
+            f"{self.stats['dirs']} dirs, {self.stats['changed']} changed, "
+            f"{self.stats['added']} added, {self.stats['gone']} gone "
+            f"in {self.stats['seconds']}s"
+        )
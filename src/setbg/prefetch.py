@@ -0,0 +1,91 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from os import remove
+from threading import Lock
+from typing import Self
+
+from setbg.common import LNAME
+from setbg.common import cache_max
+from setbg.cache import release
+from setbg.setbg import Staged, stage_image
+
+log = getLogger(LNAME)
+
+Key = tuple[str, ...]  # the images shown together, one per monitor or one
+
+
+class Prefetcher:
+    "Render upcoming images on a worker thread while the current one shows"
+
+    def __init__(self: Self, depth: int) -> None:
+        "start a single render worker, depth is how many changes to stage"
+        self.depth = depth
+        self.staged: dict[Key, Future[Staged]] = {}
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="prefetch")
+        self.lock = Lock()
+
+    def fill(self: Self, upcoming: list[Key]) -> None:
+        "stage the upcoming images and drop any that are no longer queued"
+        upcoming = upcoming[: self.depth]
+        with self.lock:
+            for key in list(self.staged):
+                if key not in upcoming:
+                    self.discard(key)
+            for key in upcoming:
+                if key not in self.staged:
+                    log.debug(f"prefetching: {key}")
+                    fut = self.executor.submit(stage_image, key)
+                    self.staged[key] = fut
+
+    def submit(self: Self, key: Key) -> Future[Staged]:
+        "future for the staged renders of key, starting them if needed"
+        with self.lock:
+            fut = self.staged.pop(key, None)
+            if fut is None:
+                fut = self.executor.submit(stage_image, key)
+        return fut
+
+    def take(self: Self, key: Key) -> Staged:
+        "return the staged renders for key, rendering them now if needed"
+        return self.submit(key).result()
+
+    def invalidate(self: Self, img: str) -> None:
+        "drop any staged render using a source that has gone"
+        with self.lock:
+            for key in list(self.staged):
+                if img in key:
+                    self.discard(key)
+
+    def discard(self: Self, key: Key) -> None:
+        "forget a staged render, call with the lock held"
+        fut = self.staged.pop(key, None)
+        if fut is None or fut.cancel():
+            return
+        log.debug(f"discarding staged: {key}")
+        if cache_max[0]:
+            fut.add_done_callback(release_staged)
+        else:
+            fut.add_done_callback(remove_staged)
+
+    def close(self: Self) -> None:
+        "stop the worker dropping anything not yet started"
+        with self.lock:
+            for key in list(self.staged):
+                self.discard(key)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def remove_staged(fut: Future[Staged]) -> None:
+    "remove uncached staged files once their render finishes"
+    if fut.exception() is None:
+        for path in set(path for _, path in fut.result()):
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def release_staged(fut: Future[Staged]) -> None:
+    "let the cache evict renders that will not be shown"
+    if fut.exception() is None:
+        release([path for _, path in fut.result()])
@@ -0,0 +1,124 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from cProfile import Profile
+from logging import getLogger
+from pstats import SortKey, Stats
+from sys import version_info
+from threading import Event, Lock, Thread, setprofile
+from time import perf_counter
+from typing import Self
+
+import tracemalloc
+
+from os.path import join as pjoin
+
+from setbg.common import BG_HOME, ENC, LNAME
+from setbg.common import PROFILE_NAME, PROFILE_SAMPLE, PROFILE_TOP
+from setbg.common import profile_on
+
+log = getLogger(LNAME)
+
+
+class Profiler:
+    "CPU profile of every thread and the allocation sites at peak memory"
+
+    def __init__(self: Self, name: str) -> None:
+        "the report goes to BG_HOME named for the program"
+        self.path = pjoin(BG_HOME, PROFILE_NAME.format(name))
+        self.main = Profile()
+        self.threads: list[Profile] = []
+        self.lock = Lock()
+        self.peak = 0
+        self.snapshot: tracemalloc.Snapshot | None = None
+        self.done = Event()
+        self.start = 0.0
+
+    def begin(self: Self) -> None:
+        "start tracing allocations and profiling this and new threads"
+        self.start = perf_counter()
+        tracemalloc.start()
+        # started before the hook so the sampler is not profiled
+        Thread(target=self.sample, daemon=True).start()
+        if version_info < (3, 12):
+            setprofile(self.hook)
+        # from 3.12 one profiler sees every thread and only one may run
+        self.main.enable()
+
+    def hook(self: Self, *_) -> None:
+        "profile a thread started while profiling, from its first call"
+        profile = Profile()
+        with self.lock:
+            self.threads.append(profile)
+        profile.enable()
+
+    def sample(self: Self) -> None:
+        "check memory in use until profiling is done"
+        while not self.done.wait(PROFILE_SAMPLE):
+            self.check()
+
+    def check(self: Self) -> None:
+        "snapshot the allocations when memory in use is the highest yet"
+        (current, _) = tracemalloc.get_traced_memory()
+        if current > self.peak:
+            self.peak = current
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def finish(self: Self) -> None:
+        "stop profiling and write the report"
+        self.main.disable()
+        if version_info < (3, 12):
+            setprofile(None)
+        self.check()
+        self.done.set()
+        elapsed = perf_counter() - self.start
+        (_, peak) = tracemalloc.get_traced_memory()
+        try:
+            from resource import RUSAGE_SELF, getrusage
+
+            # pixel buffers are allocated outside tracemalloc's view
+            maxrss = getrusage(RUSAGE_SELF).ru_maxrss / 2**10
+            rss = f", peak RSS {maxrss:.1f} MiB"
+        except ImportError:
+            rss = ""
+        with open(self.path, "w", encoding=ENC) as fp:
+            stats = Stats(self.main, stream=fp)
+            with self.lock:
+                for profile in self.threads:
+                    stats.add(profile)
+            fp.write(
+                f"{elapsed:.2f}s of every thread, "
+                f"peak traced memory {peak / 2**20:.1f} MiB{rss}\n"
+            )
+            fp.write("\nHot functions by total time\n")
+            stats.sort_stats(SortKey.TIME).print_stats(PROFILE_TOP)
+            fp.write("Hot functions by cumulative time\n")
+            stats.sort_stats(SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+            fp.write(
+                f"Allocation sites at {self.peak / 2**20:.1f} MiB, "
+                "the highest sampled\n\n"
+            )
+            if self.snapshot:
+                snapshot = self.snapshot.filter_traces(
+                    [
+                        tracemalloc.Filter(False, tracemalloc.__file__),
+                        tracemalloc.Filter(False, "<frozen importlib.*"),
+                    ]
+                )
+                for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+                    fp.write(f"{stat}\n")
+        tracemalloc.stop()
+        log.info(f"profile written to {self.path}")
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[None]:
+    "run a block under the profiler when --profile is given"
+    if not profile_on[0]:
+        yield
+        return
+    profiler = Profiler(name)
+    profiler.begin()
+    try:
+        yield
+    finally:
+        profiler.finish()
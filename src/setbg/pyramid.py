@@ -0,0 +1,34 @@
+from threading import Lock
+from typing import Self
+
+from PIL.Image import Image
+
+from setbg.common import PYRAMID_GAP
+
+
+class Pyramid:
+    "Halved copies of a decoded source, made as scaling needs them"
+
+    def __init__(self: Self, image: Image) -> None:
+        "the source is the first level, shared by every render of it"
+        self.levels = [image]
+        self.lock = Lock()
+
+    @property
+    def source(self: Self) -> Image:
+        "the full size source"
+        return self.levels[0]
+
+    def level(self: Self, size: tuple[int, int]) -> Image:
+        """smallest level at least PYRAMID_GAP times size, so resampling
+        it to size looks the same as resampling the source"""
+        with self.lock:
+            i = 0
+            while True:
+                img = self.levels[i]
+                half = ((img.size[0] + 1) // 2, (img.size[1] + 1) // 2)
+                if any(h < s * PYRAMID_GAP for h, s in zip(half, size)):
+                    return img
+                i += 1
+                if i == len(self.levels):
+                    self.levels.append(img.reduce(2))
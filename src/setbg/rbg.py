@@ -1,37 +1,58 @@
-from datetime import datetime
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
-from PIL import UnidentifiedImageError
-from socket import socket, timeout
-from typing import Self
-
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers.api import BaseObserver
+from json import dumps
+from selectors import DefaultSelector, EVENT_READ
+from socket import socket, socketpair
+from typing import Any, Self
 
 from socket import AF_INET, SOCK_DGRAM
 
-from random import seed, sample, shuffle
-from watchdog.observers import Observer
-from setbg.common import r, res_set, system_name, TREE_UMASK
+from random import seed
+from threading import Event, Lock, Thread, Timer
+from time import monotonic, perf_counter
+from setbg.common import decode_mode, metrics_on, profile_on, r, res_set
+from setbg.common import system_name
+from setbg.common import TREE_UMASK
 from shutil import rmtree
 
 from logging import getLogger
-from os import getpid, listdir, system, walk, mkdir, umask
-from os.path import isdir, realpath, expanduser
-from yaml import safe_load
+from os import cpu_count, getpid, stat, system, umask
+from os.path import dirname, isdir, realpath, expanduser, sep
 
 from os.path import join as pjoin
 
-from setbg.common import SetBGException
+from setbg.common import BadImage, ImageError, SetBGException
 
-from setbg.common import BG_HOME, BOUNCE, D_EXCLUDE, LNAME, SLEEP
+from setbg.common import BG_HOME, ENC, LNAME, POLL_RATE, PREFETCH, SLEEP
+from setbg.common import VALIDATE_SETTLE
 
 from setbg.common import (
     base_arg_handler,
     base_args,
     check_env,
     check_image,
+    encoding,
+    out_ext,
+    render_settings,
+    use_render_settings,
 )
-from setbg.setbg import set_background, rsbg, gen_image
+from setbg.setbg import apply_background, rsbg, gen_image, screens
+from setbg.setbg import Staged
+from setbg.prefetch import Key, Prefetcher
+from setbg.profiling import profiled
+from setbg.dedup import Dedup
+from setbg.index import ScanIndex
+from setbg.manifest import Manifest
+from setbg.imageset import ImageSet, sample_stream
+from setbg.scan import walk_trees
+from setbg.validate import Validator
+from setbg.cache import cache_key, report
+from setbg.rbgn import ADDRESS, MSG_EXIT, MSG_NEXT, MSG_PAUSE, MSG_PREV
+from setbg.rbgn import MSG_RESCAN, MSG_RESUME, MSG_SET, MSG_STATUS
+from setbg import metrics
 
 
 NAME = "RBG"
@@ -39,12 +60,25 @@ DESC = "RBG: A Background Changer"
 
 log = getLogger(LNAME)
 
-ADDRESS = ("localhost", 37432)
-MSG_EXIT = "X"
-MSG_NEXT = "N"
-WAIT = 0.25
+JOB_CHUNK = 16  # largest batch of tree jobs sent to a worker at once
+JOB_PROGRESS = 100  # log tree generation progress every this many images
+HISTORY = 50  # shown images remembered for going back
+
+Job = tuple[str, str, tuple[int, int]]  # source, destination, resolution
+
+observer: Any = None  # watchdog observer when --notify is used
+poller: Any = None  # directory poller when --poll is used
+prefetcher: Prefetcher | None = None
+rotation: "Rotation | None" = None
+
 
-observer: BaseObserver | None = None
+def file_state(fp: str) -> tuple[int, int] | None:
+    "size and mtime of a file, None if it cannot be read"
+    try:
+        st = stat(fp)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
 
 
 def is_directory(dname: str) -> Path:
@@ -66,190 +100,714 @@ def is_file(fname: str) -> Path:
 class Images:
     "Image List and Directory Handler" ""
 
+    scan_index: ScanIndex | None = None
+    dedup: Dedup | None = None
+    validator: Validator | None = None
+
     def __init__(self: Self) -> None:
-        "initialize arrays for per directory list and flat image list"
+        "initialize per directory sets and the shuffled rotation"
+        self.rotation = ImageSet()
+        # watcher, poller and settle timers apply one update at a time
+        self.update_lock = Lock()
         self.reset()
         seed()
 
     def reset(self: Self) -> None:
         "reset the image lists and index"
-        self.dir_images: dict[str, list[str]] = {}
-        self.images: list[str] = []
-        self.index = 0
+        self.dir_images: dict[str, set[str]] = {}
+        self.dupes: set[str] = set()
+        # quarantined this run -> (size, mtime) when it failed
+        self.bad: dict[str, tuple[int, int] | None] = {}
+        self.rotation.clear()
+        self.ready = Event()
+
+    def __len__(self: Self) -> int:
+        "number of images in the rotation"
+        return len(self.rotation)
 
     @property
     def empty(self: Self) -> bool:
-        "do we have any directories"
-        return len(self.dir_images) == 0
+        "do we have any images"
+        return not any(self.dir_images.values())
 
     def update_images(self: Self) -> None:
-        "update flat image list from directories"
-        self.images = []
-        for d in self.dir_images:
-            self.images.extend(self.dir_images[d])
-        shuffle(self.images)
-        if self.index >= len(self.images):
-            self.index = 0
+        "add every scanned image to the rotation"
+        self.rotation.extend(chain.from_iterable(self.dir_images.values()))
+
+    def walk(self: Self, roots: list[str]) -> Iterator[tuple[str, list[str]]]:
+        "stream (directory, images) for roots, through the index if set"
+        if self.scan_index:
+            return self.scan_index.walk(roots)
+        return walk_trees(roots)
+
+    def scan_tree(self: Self, dir: str) -> list[str]:
+        "list the images in a directory tree"
+        return [fp for _, imgs in self.walk([dir]) for fp in imgs]
 
     def update_dir_tree(self: Self, dir: str) -> None:
         "update images in a directory tree"
         log.info(f"Updating directory tree: {dir}")
-        self.dir_images[dir] = []
-        for root, dirs, files in walk(dir):
-            dirs[:] = [d for d in dirs if d not in D_EXCLUDE]
-            if files:
-                for fn in files:
-                    fp = pjoin(root, fn)
-                    try:
-                        fp = check_image(fp)
-                        self.dir_images[dir].append(fp)
-                    except SetBGException:
-                        pass
-
-    def update_dir(self: Self, dir: str) -> None:
-        "update images in a directory"
-        log.info(f"Updating directory: {dir}")
-        self.dir_images[dir] = []
-        files = listdir(dir)
-        for fn in files:
-            fp = pjoin(dir, fn)
-            try:
-                fp = check_image(fp)
-                self.dir_images[dir].append(fp)
-            except SetBGException:
-                pass
+        for fp in self.scan_tree(dir):
+            self.dir_images.setdefault(dirname(fp), set()).add(fp)
+
+    def load_trees(self: Self, roots: list[str]) -> None:
+        "add images to the rotation as the scan finds them"
+        try:
+            for _, imgs in self.walk(roots):
+                for fp in imgs:
+                    self.add_image(fp)
+                if imgs:
+                    self.ready.set()
+            log.info(f"Scan finished: {len(self)} images")
+        finally:
+            self.ready.set()
+        if self.remove_duplicates() and rotation:
+            rotation.notify_changed()
+        self.recheck()
+
+    def add_image(self: Self, fp: str) -> None:
+        "add an image to its directory and the rotation"
+        with self.rotation.lock:
+            if fp in self.dupes or self.still_bad(fp):
+                return
+            if not self.rotation.add(fp):
+                return
+            self.dir_images.setdefault(dirname(fp), set()).add(fp)
+        if self.validator:
+            self.validator.submit([fp])
+        log.debug(f"Added image: {fp}")
+
+    def remove_image(self: Self, fp: str) -> None:
+        "remove an image from its directory and the rotation"
+        with self.rotation.lock:
+            if not self.rotation.remove(fp):
+                return
+            dir = dirname(fp)
+            self.dir_images[dir].discard(fp)
+            if not self.dir_images[dir]:
+                del self.dir_images[dir]
+        log.debug(f"Removed image: {fp}")
+
+    def quarantine(self: Self, fp: str, error: str, persist=False) -> None:
+        """keep a file that cannot be shown out of the rotation, persist
+        records a decode failure so later runs skip it too"""
+        with self.rotation.lock:
+            if fp in self.bad:
+                return
+            self.bad[fp] = file_state(fp)
+            self.remove_image(fp)
+        log.warning(f"Quarantined: {error}")
+        if persist and self.validator:
+            self.validator.mark(fp, error)
+        if prefetcher:
+            prefetcher.invalidate(fp)
+        if rotation:
+            rotation.notify_changed()
+
+    def still_bad(self: Self, fp: str) -> bool:
+        "is a file quarantined and unchanged since, forgetting it if changed"
+        if fp not in self.bad:
+            return False
+        state = file_state(fp)
+        if state is None or state == self.bad[fp]:
+            return True
+        del self.bad[fp]
+        log.info(f"Changed since quarantined: {fp}")
+        return False
+
+    def changed_bad(self: Self) -> list[str]:
+        "quarantined files that have changed since, to check again"
+        with self.rotation.lock:
+            return [fp for fp in list(self.bad) if not self.still_bad(fp)]
+
+    def valid(self: Self, imgs: list[str]) -> list[str]:
+        "the images whose headers check out, checked now"
+        if not self.validator:
+            return imgs
+        return self.validator.valid(imgs)
+
+    def report_bad(self: Self) -> None:
+        """write the quarantine report, which the background validator only
+        writes while RBG runs"""
+        if self.validator:
+            self.validator.idle()
+
+    def remove_tree(self: Self, dir: str) -> list[str]:
+        "remove every image under a directory, returning what was removed"
+        prefix = dir.rstrip(sep) + sep
+        with self.rotation.lock:
+            dirs = [
+                d for d in self.dir_images if d == dir or d.startswith(prefix)
+            ]
+            removed = [fp for d in dirs for fp in self.dir_images[d]]
+            for fp in removed:
+                self.remove_image(fp)
+        return removed
+
+    def rescan(self: Self, roots: list[str]) -> list[str]:
+        "walk the roots again adding new images and dropping missing ones"
+        found: set[str] = set()
+        self.dupes.clear()
+        for _, imgs in self.walk(roots):
+            for fp in imgs:
+                found.add(fp)
+                self.add_image(fp)
+        with self.rotation.lock:
+            gone = [fp for fp in self.rotation.images if fp not in found]
+        for fp in gone:
+            self.remove_image(fp)
+        log.info(f"Rescan finished: {len(self)} images, {len(gone)} removed")
+        dupes = self.remove_duplicates()
+        self.recheck()
+        return gone + dupes
+
+    def update(self: Self, added: list[str], gone: list[str]) -> None:
+        """apply images found and lost by polling, gone first so a moved
+        file is not taken for a copy of itself, and quarantined files and
+        files hashed before that have changed"""
+        with self.update_lock:
+            self.apply(added, gone)
+
+    def apply(self: Self, added: list[str], gone: list[str]) -> None:
+        "update with the update lock held"
+        added += [fp for fp in self.changed_bad() if fp not in gone]
+        stale = self.dedup.changed(added) if self.dedup else []
+        for fp in gone:
+            self.bad.pop(fp, None)
+            self.remove_image(fp)
+        for fp in gone + stale:
+            self.dupes.discard(fp)
+            kept = self.dedup.forget(fp) if self.dedup else None
+            if kept:
+                self.dupes.discard(kept)
+                added.append(kept)
+        if self.dedup and added:
+            keep = set(self.dedup.unique(added))
+            dupes = [fp for fp in added if fp not in keep]
+            self.dupes.update(dupes)
+            for fp in dupes:
+                # shown while it was still being written
+                self.remove_image(fp)
+            added = [fp for fp in added if fp in keep]
+            self.recheck()
+        for fp in added:
+            self.add_image(fp)
+        if prefetcher:
+            for fp in gone:
+                prefetcher.invalidate(fp)
+        if rotation and (added or gone):
+            rotation.notify_changed()
+
+    def recheck(self: Self) -> None:
+        "look for copies again among files held back as still being written"
+        if not self.dedup or not self.dedup.held:
+            return
+        held = list(self.dedup.held)
+        timer = Timer(VALIDATE_SETTLE, self.update, (held, []))
+        timer.daemon = True
+        timer.start()
+
+    def remove_duplicates(self: Self, fresh=True) -> list[str]:
+        """drop copies of images already in the rotation, returning them,
+        fresh forgets images seen by earlier calls"""
+        if not self.dedup:
+            return []
+        if fresh:
+            self.dedup.reset()
+        with self.rotation.lock:
+            imgs = list(self.rotation.images)
+        keep = set(self.dedup.unique(imgs))
+        dupes = [fp for fp in imgs if fp not in keep]
+        with self.rotation.lock:
+            self.dupes.update(dupes)
+            for fp in dupes:
+                self.remove_image(fp)
+        log.info(
+            f"Duplicates: {len(dupes)} removed, "
+            f"{self.dedup.stats['hashed']} hashed, "
+            f"{self.dedup.stats['reused']} from the index"
+        )
+        return dupes
+
+    def reshuffle(self: Self, key: str) -> None:
+        "put the rotation in an order fixed by key, for repeatable runs"
+        with self.rotation.lock:
+            imgs = sorted(self.rotation.images)
+            self.rotation.clear()
+            seed(key)
+            self.rotation.extend(imgs)
 
     def get_next_image(self: Self) -> str:
-        "get next image in the list"
-        if not self.images:
+        "get next image in the rotation"
+        image = self.rotation.next()
+        if image is None:
             raise SetBGException("No images available")
-        index = self.index
-        self.index += 1
-        if self.index >= len(self.images):
-            self.index = 0
-        return self.images[index]
+        return image
 
-    def get_sample(self: Self, limit: int) -> list[str]:
-        "get a sample of images from the list"
-        if not self.images:
-            raise SetBGException("No images available")
-        if limit <= 0 or limit >= len(self.images):
-            return self.images
-        return sample(self.images, limit)
+    def peek(self: Self, count: int) -> list[str]:
+        "get the next count images without advancing"
+        return self.rotation.peek(count)
 
+    def sample_tree(
+        self: Self, dir: str, limit: int, picked: set[str], seed=None
+    ) -> list[str]:
+        """sample up to limit images while walking a tree, keeping those
+        in picked, without holding the whole tree, walking again to refill
+        the places of duplicates and bad files"""
+        imgs: list[str] = []
+        tried: set[str] = set()
+        while len(imgs) < limit:
+            want = limit - len(imgs)
+            kept: list[str] = []
 
-images = Images()
+            def others() -> Iterator[str]:
+                for _, found in self.walk([dir]):
+                    for fp in found:
+                        if fp in tried:
+                            continue
+                        if fp in picked and len(kept) < want:
+                            kept.append(fp)
+                        else:
+                            yield fp
 
+            chosen = sample_stream(others(), want, seed)
+            batch = kept + chosen[: want - len(kept)]
+            if not batch:
+                break
+            tried.update(batch)
+            if self.dedup:
+                batch = self.dedup.unique(batch)
+            batch = self.valid(batch)
+            if len(batch) < want:
+                log.debug(f"sample refill: {want - len(batch)} rejected")
+            imgs += batch
+        if not imgs:
+            raise SetBGException("No images available")
+        return imgs
 
-class FSHandler(FileSystemEventHandler):
-    "File System Event Handler for Directory Changes"
+    def get_sample(self: Self, limit: int) -> list[str]:
+        "get a sample of images from the list"
+        if not len(self.rotation):
+            raise SetBGException("No images available")
+        return self.rotation.sample(limit)
 
-    last_when = datetime.now()
-    last_dir = ""
 
-    def on_modified(self: Self, event):
-        "rescan modified directories, ignore if less than a quarter second"
-        if event.is_directory:
-            if self.last_dir == event.src_path:
-                if (datetime.now() - self.last_when).total_seconds() < BOUNCE:
-                    return
-            self.last_when = datetime.now()
-            self.last_dir = event.src_path
-            images.update_dir(str(event.src_path))
-            images.update_images()
+images = Images()
 
 
 def signal_handler(signum: int, _) -> None:
     "handle signals"
     global observer
     log.info("Signal received, exiting")
+    log.info(report())
     if observer:
         observer.stop()
+    if prefetcher:
+        prefetcher.close()
     rsbg()
     exit(0)
 
 
-def rbg(dirs: list[str], wait: float, notify: bool) -> None:
-    "feed the background changer"
-    global observer
+class Rotation:
+    "Selector driven rotation waiting on control, timer and scan events"
+
+    def __init__(
+        self: Self,
+        sock: socket,
+        roots: list[str],
+        wait: float,
+        group=1,
+        stop=0,
+    ):
+        """register the control socket and a wakeup pair for worker threads,
+        group is how many images are shown together, stop how many changes
+        to show before exiting, 0 for no limit"""
+        self.sock = sock
+        self.roots = roots
+        self.wait = wait
+        self.group = group
+        self.stop = stop
+        self.shown = 0
+        self.selector = DefaultSelector()
+        self.wake_r, self.wake_w = socketpair()
+        self.wake_r.setblocking(False)
+        self.selector.register(sock, EVENT_READ, self.control)
+        self.selector.register(self.wake_r, EVENT_READ, self.woken)
+        self.history: deque[Key] = deque(maxlen=HISTORY)
+        self.current: Key | None = None
+        self.pending: tuple[Key, Future[Staged], float] | None = None
+        self.deadline: float | None = None
+        self.paused = False
+        self.changed = False
+        self.last_render = 0.0
+        self.requests: deque[tuple[str, Any]] = deque()
+        self.reply_to: Any = None
+        self.running = True
+
+    def wake(self: Self, *_) -> None:
+        "wake the loop from another thread"
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def notify_changed(self: Self) -> None:
+        "the image list changed, refill the prefetch queue in the loop"
+        self.changed = True
+        self.wake()
+
+    def upcoming(self: Self) -> list[Key]:
+        "the next changes to prefetch, grouped as they will be shown"
+        assert prefetcher
+        imgs = images.peek(prefetcher.depth * self.group)
+        return [
+            tuple(imgs[i : i + self.group])
+            for i in range(0, len(imgs) - self.group + 1, self.group)
+        ]
+
+    def advance(self: Self, image: Key | None = None) -> None:
+        "start rendering the next images, or image when going back"
+        if self.pending:
+            return
+        if image is None:
+            if not len(images):
+                return
+            image = tuple(
+                images.get_next_image() for _ in range(self.group)
+            )
+        assert prefetcher
+        fut = prefetcher.submit(image)
+        self.pending = (image, fut, monotonic())
+        self.deadline = None
+        fut.add_done_callback(self.wake)
+
+    def finish(self: Self) -> None:
+        "show a finished render and arm the timer"
+        assert self.pending and prefetcher
+        image, fut, start = self.pending
+        if not fut.done():
+            return
+        self.pending = None
+        try:
+            staged = fut.result()
+        except ImageError as e:
+            if self.reply_to:
+                self.reply({"error": str(e)})
+                self.rearm()
+            else:
+                images.quarantine(e.image, str(e), isinstance(e, BadImage))
+                self.advance()
+            return
+        print(f"Image: {', '.join(image)}")
+        apply_background(staged)
+        self.last_render = monotonic() - start
+        self.current = image
+        self.history.append(image)
+        log.debug(report())
+        if metrics_on[0]:
+            log.info(metrics.report())
+        if self.reply_to:
+            self.reply({"image": ", ".join(image)})
+        self.shown += 1
+        if self.stop and self.shown >= self.stop:
+            log.info(f"stopping after {self.shown} images")
+            self.running = False
+            return
+        prefetcher.fill(self.upcoming())
+        self.rearm()
+
+    def rearm(self: Self) -> None:
+        "time the next change, then take any waiting SetBG request"
+        if not self.paused and len(images):
+            self.deadline = monotonic() + self.wait
+        self.serve()
+
+    def serve(self: Self) -> None:
+        "show the next image sent by SetBG or RSBG once nothing renders"
+        while self.requests and not self.pending:
+            path, self.reply_to = self.requests.popleft()
+            try:
+                img = check_image(path, True)
+            except SetBGException as e:
+                self.reply({"error": str(e)})
+                continue
+            self.advance((img,))
+
+    def reply(self: Self, answer: dict) -> None:
+        "answer the SetBG or RSBG waiting on the image just handled"
+        try:
+            self.sock.sendto(dumps(answer).encode(ENC), self.reply_to)
+        except OSError as e:
+            log.warning(f"Unable to reply to {self.reply_to}: {e}")
+        self.reply_to = None
+
+    def woken(self: Self) -> None:
+        "handle wakeups from render, watcher and rescan threads"
+        try:
+            while self.wake_r.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        if self.changed and prefetcher:
+            self.changed = False
+            prefetcher.fill(self.upcoming())
+        if self.pending:
+            self.finish()
+
+    def control(self: Self) -> None:
+        "handle a message from RBGN"
+        data, addr = self.sock.recvfrom(4096)
+        msg = data.decode(ENC)
+        log.info(f"control message: {msg}")
+        if msg == MSG_EXIT:
+            self.running = False
+        elif msg == MSG_NEXT:
+            self.advance()
+        elif msg == MSG_PREV:
+            if len(self.history) > 1 and not self.pending:
+                self.history.pop()
+                self.advance(self.history.pop())
+        elif msg == MSG_PAUSE:
+            self.paused = True
+            self.deadline = None
+        elif msg == MSG_RESUME:
+            if self.paused and not self.pending:
+                self.deadline = monotonic() + self.wait
+            self.paused = False
+        elif msg == MSG_RESCAN:
+            Thread(target=self.rescan, daemon=True).start()
+        elif msg == MSG_STATUS:
+            self.sock.sendto(dumps(self.status()).encode(ENC), addr)
+        elif msg.startswith(MSG_SET):
+            self.requests.append((msg[len(MSG_SET) :], addr))
+            self.serve()
+        else:
+            log.warning(f"Unknown control message: {msg}")
+
+    def rescan(self: Self) -> None:
+        "rescan the roots off the loop thread"
+        gone = images.rescan(self.roots)
+        if prefetcher:
+            for fp in gone:
+                prefetcher.invalidate(fp)
+        self.notify_changed()
+
+    def status(self: Self) -> dict:
+        "state reported to RBGN --status"
+        return {
+            "image": ", ".join(self.current) if self.current else None,
+            "paused": self.paused,
+            "images": len(images),
+            "quarantined": len(images.bad),
+            "polled": poller.report() if poller else None,
+            "queue": len(prefetcher.staged) if prefetcher else 0,
+            "requests": len(self.requests),
+            "last_render": round(self.last_render, 3),
+            "next_in": (
+                round(max(0.0, self.deadline - monotonic()), 1)
+                if self.deadline
+                else None
+            ),
+        }
+
+    def run(self: Self) -> None:
+        "loop until asked to exit, sleeping until the next event"
+        self.advance()
+        while self.running:
+            delay = None
+            if self.deadline is not None:
+                delay = max(0.0, self.deadline - monotonic())
+            events = self.selector.select(delay)
+            for key, _ in events:
+                key.data()
+            if self.deadline is not None and monotonic() >= self.deadline:
+                self.advance()
+
+    def close(self: Self) -> None:
+        "release the selector and wakeup pair"
+        self.selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+
+def rbg(
+    dirs: list[str],
+    wait: float,
+    notify: bool,
+    depth: int,
+    mixed=False,
+    poll=0.0,
+    poll_rate=POLL_RATE,
+    stop=0,
+    seed: str | None = None,
+) -> None:
+    """feed the background changer, stopping after stop changes, seed
+    fixes the order after the full scan for repeatable runs"""
+    global observer, poller, prefetcher, rotation
     if notify:
+        from watchdog.observers import Observer
+        from setbg.watch import FSHandler
+
         observer = Observer()
     else:
         observer = None
     # listen here
     udp_socket = socket(AF_INET, SOCK_DGRAM)
     udp_socket.bind(ADDRESS)
-    udp_socket.settimeout(WAIT)
+    roots = []
     for dn in dirs:
         dname = realpath(expanduser(dn))
         if not isdir(dname):
             log.warning("Skipping non directory: {}".format(dname))
             continue
         log.info("Adding directory: {}".format(dname))
-        images.update_dir_tree(dname)
+        roots.append(dname)
         if observer:
             observer.schedule(FSHandler(), path=dname, recursive=True)
-    if images.empty:
-        raise SetBGException("No images found, exiting")
-    images.update_images()
-    image = None
-    if not images.images:
+    loader = Thread(target=images.load_trees, args=(roots,), daemon=True)
+    loader.start()
+    if poll and roots and images.scan_index:
+        from setbg.poll import Poller
+
+        poller = Poller(
+            images.scan_index, roots, poll, images.update, poll_rate
+        )
+        Thread(target=poller.run, args=(loader,), daemon=True).start()
+    if seed:
+        loader.join()
+        images.reshuffle(seed)
+    images.ready.wait()
+    if roots and not len(images):
         raise SetBGException("No images found, exiting")
+    if not roots:
+        log.info("No directories, waiting for SetBG and RSBG")
+    prefetcher = Prefetcher(depth)
+    group = len(screens()) if mixed else 1
+    rotation = Rotation(udp_socket, roots, wait, group, stop)
     if observer:
         observer.start()
-    while True:
-        try:
-            image = images.get_next_image()
-            # log.info(f"Setting background to: {image}")
-            print(f"Image: {image}")
-            set_background(image)
-            for _ in range(int(wait / WAIT)):
-                try:
-                    x = udp_socket.recvfrom(1024)[0].decode()
-                    if x == MSG_EXIT:
-                        log.info("exit requested")
-                        raise KeyboardInterrupt
-                    else:
-                        log.info("change requested")
-                        break
-                except timeout:
-                    pass
-        except UnidentifiedImageError:
-            log.warning(f"Unidentified image file, skipping: {image}")
-        except SetBGException as e:
-            if observer:
-                observer.stop()
-            raise e
-        except KeyboardInterrupt:
-            log.info("Exiting RBG")
-            if observer:
-                observer.stop()
-            break
-
-
-def gtbg(dir: Path, tree: Path, limit: int) -> None:
-    "Generate image tree of preset size"
+    try:
+        rotation.run()
+        log.info("exit requested")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        log.info("Exiting RBG")
+        log.info(report())
+        if metrics_on[0]:
+            log.info(metrics.report())
+        if observer:
+            observer.stop()
+        if poller:
+            poller.running = False
+        prefetcher.close()
+        rotation.close()
+        rotation = None
+        udp_socket.close()
+
+
+def gtbg(
+    dir: Path,
+    tree: Path,
+    limit: int,
+    manifest: Manifest | None = None,
+    seed: str | None = None,
+) -> list[Job]:
+    """Plan image tree of preset size, returning the render jobs,
+    only those out of date when syncing with a manifest"""
+    jobs: list[Job] = []
     if not dir.is_dir():
         log.warning("Skipping non directory: {}".format(dir))
-        return
+        return jobs
     if system_name == "Linux":
         umask(TREE_UMASK)
-    images.update_dir_tree(str(dir))
-    images.update_images()
     log.debug(f"Processing directory: {dir}")
-    imgs = images.get_sample(limit)
+    if limit > 0:
+        picked = manifest.picked(str(dir)) if manifest else set()
+        imgs = images.sample_tree(str(dir), limit, picked, seed)
+    else:
+        images.update_dir_tree(str(dir))
+        images.update_images()
+        images.remove_duplicates(fresh=False)
+        imgs = images.valid(images.get_sample(0))
     log.info(f"images selected: {imgs}")
     for image in imgs:
         log.debug(f"Processing: {image}")
         img_path = tree / Path(image).relative_to(Path(dir))
+        img_path = img_path.with_suffix(out_ext())
+        if manifest:
+            try:
+                key = cache_key(
+                    image, (r[0], r[1]), decode_mode[0], *encoding()
+                )
+            except ImageError as e:
+                log.warning(f"{e}, skipping")
+                continue
+            if not manifest.plan(str(img_path), image, key):
+                continue
         if not img_path.parent.exists():
-            mkdir(img_path.parent)
-        img_path = img_path.with_suffix(".jpg")
-        try:
-            log.debug(f"Generating: {img_path}")
-            gen_image(image, str(img_path))
-        except UnidentifiedImageError:
-            log.warning(f"Unidentified image file, skipping: {image}")
+            img_path.parent.mkdir(parents=True)
+        jobs.append((image, str(img_path), (r[0], r[1])))
+    return jobs
+
+
+def gen_job(job: Job) -> str | None:
+    "render one tree image at its own resolution, return an error or None"
+    image, dst, res = job
+    r[0] = res[0]
+    r[1] = res[1]
+    log.debug(f"Generating: {dst}")
+    try:
+        gen_image(image, dst)
+    except ImageError as e:
+        return f"{e}, skipping"
+    return None
+
+
+def run_jobs(jobs: list[Job], njobs: int, stop=0) -> set[str]:
+    """render tree jobs in order or over a process pool, report and
+    return the destinations that failed, only the first stop when set"""
+    start = perf_counter()
+    failed: set[str] = set()
+    if stop and len(jobs) > stop:
+        log.info(f"stopping after {stop} of {len(jobs)} images")
+        # left out of a synced manifest so the next sync renders them
+        failed = set(dst for _, dst, _ in jobs[stop:])
+        jobs = jobs[:stop]
+    if njobs != 1 and profile_on[0]:
+        log.warning("Profiling renders the tree in this process")
+        njobs = 1
+    if njobs == 1:
+        results: Iterator[str | None] = map(gen_job, jobs)
+        pool = None
+    else:
+        workers = njobs or cpu_count() or 1
+        # workers started by spawn or forkserver do not inherit options
+        pool = ProcessPoolExecutor(
+            workers,
+            initializer=use_render_settings,
+            initargs=(render_settings(),),
+        )
+        chunk = max(1, min(len(jobs) // (4 * workers), JOB_CHUNK))
+        results = pool.map(gen_job, jobs, chunksize=chunk)
+    try:
+        for done, (job, err) in enumerate(zip(jobs, results), 1):
+            if err:
+                failed.add(job[1])
+                log.warning(err)
+            if done % JOB_PROGRESS == 0:
+                log.info(f"progress: {done}/{len(jobs)}")
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+    elapsed = perf_counter() - start
+    rate = len(jobs) / elapsed if elapsed else 0.0
+    errors = len(failed & set(dst for _, dst, _ in jobs))
+    print(
+        f"Generated {len(jobs) - errors}/{len(jobs)} images "
+        f"({errors} failed) in {elapsed:.1f}s, {rate:.2f} images/s"
+    )
+    return failed
 
 
 def make_old(dst: Path) -> None:
@@ -263,11 +821,23 @@ def make_old(dst: Path) -> None:
     dst.mkdir(exist_ok=True)
 
 
-def trbg(fpath: Path, limit: int) -> None:
-    "Generate image trees from a file list"
+def trbg(
+    fpath: Path,
+    limit: int,
+    njobs: int,
+    sync=False,
+    seed: str | None = None,
+    stop=0,
+) -> None:
+    """Generate image trees from a file list, only changes when syncing,
+    only the first stop images when set"""
     global res_set
+    jobs: list[Job] = []
+    manifests: list[Manifest] = []
     if system_name == "Linux":
         umask(TREE_UMASK)
+    from yaml import safe_load
+
     with fpath.open("r") as file:
         setup = safe_load(file)
         res_set = True
@@ -275,7 +845,15 @@ def trbg(fpath: Path, limit: int) -> None:
             r[0] = int(dir["res"].split("x")[0])
             r[1] = int(dir["res"].split("x")[1])
             dst = Path(dir["dst"])
-            make_old(dst)
+            if images.dedup:
+                images.dedup.reset()
+            manifest = None
+            if sync:
+                dst.mkdir(parents=True, exist_ok=True)
+                manifest = Manifest(dst)
+                manifests.append(manifest)
+            else:
+                make_old(dst)
             nm_file = dst / ".nomedia"
             nm_file.touch(exist_ok=True)
             log.info(
@@ -290,11 +868,14 @@ def trbg(fpath: Path, limit: int) -> None:
                     sdst = dst / subd.name
                     log.info(f"Processing subdir: {subd} -> {sdst}")
                     sdst.mkdir(exist_ok=True)
-                    gtbg(subd, sdst, limit)
+                    jobs += gtbg(subd, sdst, limit, manifest, seed)
                     images.reset()
+    images.report_bad()
+    failed = run_jobs(jobs, njobs, stop)
+    for manifest in manifests:
+        manifest.commit(failed)
 
 
-# TODO #1 add run as a demon
 def cli_rbg() -> None:
     "handle command line arguments for RBG"
     log.info("{} Started".format(NAME))
@@ -313,6 +894,41 @@ def cli_rbg() -> None:
             action="store_true",
             help="Use notification for directory changes",
         )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=0,
+            help="Seconds between checks of directory mtimes for changes, "
+            "for network mounts where notification misses them",
+        )
+        parser.add_argument(
+            "--poll-rate",
+            type=int,
+            default=POLL_RATE,
+            help=f"Directories checked a second (default {POLL_RATE})",
+        )
+        parser.add_argument(
+            "-p",
+            "--prefetch",
+            type=int,
+            default=PREFETCH,
+            help=f"Images to render ahead (default {PREFETCH})",
+        )
+        parser.add_argument(
+            "--mixed",
+            action="store_true",
+            help="With --per-monitor show a different image on each monitor",
+        )
+        parser.add_argument(
+            "--keep-duplicates",
+            action="store_true",
+            help="Show and generate every copy of identical files",
+        )
+        parser.add_argument(
+            "--rescan",
+            action="store_true",
+            help="Ignore the scan index and rebuild it",
+        )
         parser.add_argument(
             "-g",
             "--gen-tree",
@@ -331,49 +947,93 @@ def cli_rbg() -> None:
             default=0,
             help="Limit the number of images in generated tree",
         )
+        parser.add_argument(
+            "--seed",
+            help="Make the --limit selection and the rotation order "
+            "repeatable for the same files",
+        )
+        parser.add_argument(
+            "--stop-after",
+            type=int,
+            default=0,
+            help="Exit after showing or generating this many images, "
+            "for repeatable --profile runs",
+        )
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="Update generated trees in place, rendering only changes",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="Processes for tree generation, 0 uses all cores",
+        )
         parser.add_argument(
             "DIRS",
-            nargs="+",
-            help="Directories to choose images from",
+            nargs="*",
+            help="Directories to choose images from, with none RBG only "
+            "shows what SetBG and RSBG send it",
         )
         args = base_arg_handler(parser)
         wait = float(args.sleep)
         notify = bool(args.notify)
         limit = int(args.limit)
+        images.scan_index = ScanIndex(args.rescan)
+        if not args.keep_duplicates:
+            images.dedup = Dedup(images.scan_index)
+        images.validator = Validator(images.scan_index, images.quarantine)
         if args.gen_tree:
             assert isinstance(args.gen_tree, Path)
-            make_old(args.gen_tree)
-            for dir in args.DIRS:
-                d = Path(dir).expanduser().resolve(True)
-                gtbg(d, args.gen_tree, limit)
-                images.reset()
+            manifest = Manifest(args.gen_tree) if args.sync else None
+            if not manifest:
+                make_old(args.gen_tree)
+            with profiled(NAME):
+                jobs: list[Job] = []
+                for dir in args.DIRS:
+                    d = Path(dir).expanduser().resolve(True)
+                    jobs += gtbg(d, args.gen_tree, limit, manifest, args.seed)
+                    images.reset()
+                images.report_bad()
+                failed = run_jobs(jobs, args.jobs, args.stop_after)
+                if manifest:
+                    manifest.commit(failed)
             return
         if args.tree_generation:
             assert isinstance(args.tree_generation, Path)
-            trbg(args.tree_generation, limit)
+            with profiled(NAME):
+                trbg(
+                    args.tree_generation,
+                    limit,
+                    args.jobs,
+                    args.sync,
+                    args.seed,
+                    args.stop_after,
+                )
             return
         log.debug(f"sleep: {wait}")
         with open(pjoin(BG_HOME, "rbg.pid"), "w") as fp:
             fp.write(str(getpid()))
-        rbg(args.DIRS, wait, notify)
+        with profiled(NAME):
+            rbg(
+                args.DIRS,
+                wait,
+                notify,
+                args.prefetch,
+                args.mixed,
+                args.poll,
+                args.poll_rate,
+                args.stop_after,
+                args.seed,
+            )
         rsbg()
     except SetBGException as e:
         log.error(str(e))
         raise e
 
 
-def cli_rbgn():
-    parser = base_args(DESC, size=False)
-    parser.add_argument("-x", "--exit", action="store_true", help="exit")
-    args = base_arg_handler(parser, size=False)
-    if args.exit:
-        msg = MSG_EXIT
-    else:
-        msg = MSG_NEXT
-    sock = socket(AF_INET, SOCK_DGRAM)
-    sock.sendto(msg.encode(), ADDRESS)
-
-
 if __name__ == "__main__":
     "run the command line interface for RBG"
     cli_rbg()
@@ -0,0 +1,73 @@
+from logging import getLogger
+from socket import AF_INET, SOCK_DGRAM, socket, timeout
+
+from setbg.common import ENC, LNAME
+from setbg.common import base_arg_handler, base_args
+
+DESC = "RBGN: tell RBG what to do"
+
+log = getLogger(LNAME)
+
+ADDRESS = ("localhost", 37432)
+MSG_EXIT = "X"
+MSG_NEXT = "N"
+MSG_PAUSE = "S"
+MSG_PREV = "P"
+MSG_RESCAN = "R"
+MSG_RESUME = "G"
+MSG_SET = "I"  # followed by the image to show
+MSG_STATUS = "?"
+SET_WAIT = 30.0  # seconds SetBG waits for RBG to show an image
+STATUS_WAIT = 2.0  # seconds RBGN waits for a status reply
+
+
+def cli_rbgn():
+    parser = base_args(DESC, size=False)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-x", "--exit", action="store_true", help="exit")
+    group.add_argument(
+        "-p", "--prev", action="store_true", help="previous image"
+    )
+    group.add_argument("--pause", action="store_true", help="stop changing")
+    group.add_argument(
+        "--resume", action="store_true", help="start changing again"
+    )
+    group.add_argument(
+        "--rescan", action="store_true", help="rescan the directories"
+    )
+    group.add_argument(
+        "--status", action="store_true", help="show what RBG is doing"
+    )
+    args = base_arg_handler(parser, size=False)
+    if args.exit:
+        msg = MSG_EXIT
+    elif args.prev:
+        msg = MSG_PREV
+    elif args.pause:
+        msg = MSG_PAUSE
+    elif args.resume:
+        msg = MSG_RESUME
+    elif args.rescan:
+        msg = MSG_RESCAN
+    elif args.status:
+        msg = MSG_STATUS
+    else:
+        msg = MSG_NEXT
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.sendto(msg.encode(), ADDRESS)
+    if msg == MSG_STATUS:
+        from json import loads
+
+        sock.settimeout(STATUS_WAIT)
+        try:
+            status = loads(sock.recvfrom(4096)[0].decode(ENC))
+        except timeout:
+            log.error("No reply from RBG")
+            return
+        for key, value in status.items():
+            print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    "run the command line interface for RBGN"
+    cli_rbgn()
@@ -0,0 +1,52 @@
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import wait
+from logging import getLogger
+from os import scandir
+from os.path import realpath
+
+from setbg.common import D_EXCLUDE, LNAME, SCAN_WORKERS
+from setbg.common import is_image_name
+
+log = getLogger(LNAME)
+
+Lister = Callable[[str], tuple[list[str], list[str]]]
+
+
+def list_dir(dir: str) -> tuple[list[str], list[str]]:
+    "list the subdirectories and images of one directory"
+    subdirs: list[str] = []
+    imgs: list[str] = []
+    with scandir(dir) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in D_EXCLUDE:
+                    subdirs.append(entry.path)
+            elif is_image_name(entry.name):
+                if entry.is_symlink():
+                    imgs.append(realpath(entry.path))
+                else:
+                    imgs.append(entry.path)
+    return subdirs, imgs
+
+
+def walk_trees(
+    roots: list[str], lister: Lister = list_dir, workers=SCAN_WORKERS
+) -> Iterator[tuple[str, list[str]]]:
+    "yield (directory, images) as directories are listed on a thread pool"
+    with ThreadPoolExecutor(workers, thread_name_prefix="scan") as pool:
+        pending: dict[Future, str] = {}
+        for d in roots:
+            pending[pool.submit(lister, d)] = d
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                dir = pending.pop(fut)
+                try:
+                    subdirs, imgs = fut.result()
+                except OSError as e:
+                    log.warning(f"Unable to scan {dir}: {e}")
+                    continue
+                for sd in subdirs:
+                    pending[pool.submit(lister, sd)] = sd
+                yield dir, imgs
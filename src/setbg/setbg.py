@@ -1,43 +1,82 @@
 from PIL.Image import Resampling, Transpose, Image
-from setbg.common import SetBGException
+from setbg.common import BadImage, ImageTooLarge, SetBGException
 
 from setbg.common import (
     BG_HOME,
     BG_NAME,
     BG_SWITCH,
+    DECODE_MODES,
     ENC,
+    ENCODERS,
     FLIP_FIRST,
     LNAME,
-    RSBG_IMG,
+    MONITOR_WORKERS,
     SCALE_MAX,
+    STAGE_DIR,
+    TILE_BLOCK,
+    TILE_PASTE,
     TOLERANCE,
 )
-from setbg.common import r, system_name, window_manager
-
+from setbg.common import cache_max, composite, decode_mode, monitors
+from setbg.common import optimize, out_format, per_monitor, pixel_max
+from setbg.common import quality, r
+from setbg.common import subsampling
+from setbg.common import system_name
+from setbg.common import window_manager
+from setbg.cache import cache_key, entry_path, fetch, part_path, publish
+from setbg.cache import copy, pin, release, store
+from setbg.metrics import begin, end, note, stage
+from setbg.profiling import profiled
+from setbg.pyramid import Pyramid
+from setbg.xfce import set_image
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from threading import get_ident
 from logging import getLogger
+from hashlib import sha1
 from math import ceil, floor
-from os import remove, symlink
-from os.path import exists
+from time import perf_counter
+from os import getpid, remove, replace, symlink
+from os.path import basename, exists, splitext
 from PIL.ImageOps import crop, expand
 from setbg.common import (
     base_arg_handler,
     base_args,
     check_env,
     check_image,
+    encoding,
+    out_ext,
+    rsbg_image,
 )
-from subprocess import check_call, check_output
 
 from os.path import join as pjoin
 from PIL.Image import open as imopen, new as imnew
+import PIL.Image
+
+# open_image checks pixel_max against the header instead
+PIL.Image.MAX_IMAGE_PIXELS = None
 
 NAME = "SetBG"
 DESC = "SetBG: A Background Setter"
 
 log = getLogger(LNAME)
 
+ORIENTATION = 0x0112  # EXIF orientation tag
+
+Target = tuple[str, tuple[int, int]]  # monitor name, "" for all, and size
+Staged = list[tuple[str, str]]  # monitor name and finished render path
+
 
-def scale_image(img: Image, size: tuple[int, int]) -> Image:
-    "scale image to fit screen resolution"
+def scale_image(
+    img: Image,
+    size: tuple[int, int],
+    screen: tuple[int, int] | None = None,
+    levels: Pyramid | None = None,
+) -> Image:
+    """scale image to fit size, snapping to the screen resolution,
+    shrinking from the nearest level of img when given its pyramid"""
+    screen = screen or (r[0], r[1])
     ratios: list[float] = [0, 0]
     isize: list[int] = [0, 0]
     for ra in range(len(ratios)):
@@ -49,8 +88,8 @@ def scale_image(img: Image, size: tuple[int, int]) -> Image:
     scale = 0
     for i in range(len(isize)):
         isize[i] = int(round(img.size[i] * ratio))
-        if abs(isize[i] - r[i]) < TOLERANCE:
-            isize[i] = r[i]
+        if abs(isize[i] - screen[i]) < TOLERANCE:
+            isize[i] = screen[i]
         if isize[i] > img.size[i]:
             scale = 1
         elif isize[i] < img.size[i]:
@@ -60,7 +99,15 @@ def scale_image(img: Image, size: tuple[int, int]) -> Image:
         if scale > 0:
             scaled_img = img.resize(isize, Resampling.BICUBIC)
         else:
-            scaled_img = img.resize(isize, Resampling.LANCZOS)
+            src = levels.level((isize[0], isize[1])) if levels else img
+            if src is not img:
+                log.debug(f"scaling from level: {src.size}")
+            if decode_mode[0] == "speed":
+                scaled_img = src.resize(
+                    isize, Resampling.LANCZOS, reducing_gap=2
+                )
+            else:
+                scaled_img = src.resize(isize, Resampling.LANCZOS)
     else:
         scaled_img = img
     log.debug(f"scaled size: {scaled_img.size}")
@@ -74,11 +121,7 @@ def tile_image(img: Image, size: tuple[int, int], rfunc=floor):
         ratios[ra] = int(rfunc(size[ra] / float(img.size[ra])))
     log.debug(f"tile ratios: {ratios}")
     if not all([x == 1 for x in ratios]):
-        isize = (
-            round(img.size[0] * ratios[0]),
-            round(img.size[1] * ratios[1]),
-        )
-        tiled_img = imnew("RGB", isize)
+        counts = (round(ratios[0]), round(ratios[1]))
         # if we are tiling add border
         try:
             img = crop(img, border=1)
@@ -87,30 +130,97 @@ def tile_image(img: Image, size: tuple[int, int], rfunc=floor):
             print(img.info)
             log.error(f"exception (): {e}")
             exit(1)
-        for x in range(round(ratios[0])):
-            x_loc = img.size[0] * x
-            for y in range(round(ratios[1])):
-                y_loc = img.size[1] * y
-                if FLIP_FIRST:
-                    flip = 1
-                else:
-                    flip = 0
-                if (x + flip) % 2:
-                    tiled_img.paste(img, (x_loc, y_loc))
-                else:
-                    tiled_img.paste(
-                        img.transpose(Transpose.FLIP_LEFT_RIGHT),
-                        (x_loc, y_loc),
-                    )
+        if composite[0] == "numpy" and img.mode == "RGB":
+            tiled_img = tile_numpy(img, counts)
+        elif composite[0] == "paste":
+            tiled_img = tile_paste(img, counts)
+        else:
+            tiled_img = tile_fast(img, counts)
     else:
         tiled_img = img
     log.debug(f"tiled size: {tiled_img.size}")
     return tiled_img
 
 
-def make_strip(orig: Image, size: tuple[int, int]):
+def tile_paste(img: Image, counts: tuple[int, int]) -> Image:
+    "tile by pasting every tile, flipping every other column"
+    isize = (img.size[0] * counts[0], img.size[1] * counts[1])
+    tiled_img = imnew("RGB", isize)
+    for x in range(counts[0]):
+        x_loc = img.size[0] * x
+        for y in range(counts[1]):
+            y_loc = img.size[1] * y
+            if FLIP_FIRST:
+                flip = 1
+            else:
+                flip = 0
+            if (x + flip) % 2:
+                tiled_img.paste(img, (x_loc, y_loc))
+            else:
+                tiled_img.paste(
+                    img.transpose(Transpose.FLIP_LEFT_RIGHT),
+                    (x_loc, y_loc),
+                )
+    return tiled_img
+
+
+def tile_pair(img: Image) -> tuple[Image, Image]:
+    "the tiles for even and odd columns"
+    flipped = img.transpose(Transpose.FLIP_LEFT_RIGHT)
+    if FLIP_FIRST:
+        return img, flipped
+    return flipped, img
+
+
+def tile_fast(img: Image, counts: tuple[int, int]) -> Image:
+    """tile by doubling one flipped pair into a block of about TILE_BLOCK
+    pixels a side then pasting the block over the canvas, or tile by tile
+    when there are few tiles"""
+    if counts[0] * counts[1] <= TILE_PASTE:
+        # a block of these is as large as the canvas it saves pastes on
+        return tile_paste(img, counts)
+    (tw, th) = img.size
+    (width, height) = (tw * counts[0], th * counts[1])
+    # whole pairs and rows so the block repeats, small so the only large
+    # allocation is the canvas itself
+    bw = min(width, max(2, TILE_BLOCK // tw // 2 * 2) * tw)
+    bh = min(height, max(1, TILE_BLOCK // th) * th)
+    block = imnew("RGB", (bw, bh))
+    for x, tile in enumerate(tile_pair(img)[: counts[0]]):
+        block.paste(tile, (tw * x, 0))
+    done = min(2, counts[0]) * tw
+    while done < bw:
+        step = min(done, bw - done)
+        block.paste(block.crop((0, 0, step, th)), (done, 0))
+        done += step
+    done = th
+    while done < bh:
+        step = min(done, bh - done)
+        block.paste(block.crop((0, 0, bw, step)), (0, done))
+        done += step
+    tiled_img = imnew("RGB", (width, height))
+    # blocks past the right and bottom edges are clipped
+    for y in range(0, height, bh):
+        for x in range(0, width, bw):
+            tiled_img.paste(block, (x, y))
+    return tiled_img
+
+
+def tile_numpy(img: Image, counts: tuple[int, int]) -> Image:
+    "tile with whole array operations"
+    from numpy import asarray, concatenate, tile
+    from PIL.Image import fromarray
+
+    pair = concatenate([asarray(t) for t in tile_pair(img)], axis=1)
+    reps = (counts[1], (counts[0] + 1) // 2, 1)
+    return fromarray(tile(pair, reps)[:, : img.size[0] * counts[0]])
+
+
+def make_strip(
+    orig: Image, size: tuple[int, int], screen=None, levels=None
+):
     log.debug(f"strip size: {size}")
-    base_img = scale_image(orig, size)
+    base_img = scale_image(orig, size, screen, levels)
     tiled_img = tile_image(base_img, size, rfunc=ceil)
     return tiled_img
 
@@ -121,17 +231,25 @@ def x_stripe(
     x_size: int,
     striped_img: Image,
     size: tuple[int, int],
+    screen=None,
+    levels=None,
 ):
     log.debug("x stripe: {x_size}")
     xs_size = (x_strip, size[1])
-    x_img = make_strip(orig, xs_size)
+    x_img = make_strip(orig, xs_size, screen, levels)
     striped_img.paste(x_img.transpose(Transpose.FLIP_LEFT_RIGHT), (0, 0))
     striped_img.paste(x_img, (x_strip + x_size, 0))
     return
 
 
-def stripe_image(img: Image, orig: Image, size: tuple[int, int]) -> Image:
-    "add stripes to image"
+def stripe_image(
+    img: Image,
+    orig: Image,
+    size: tuple[int, int],
+    screen=None,
+    levels: Pyramid | None = None,
+) -> Image:
+    "add stripes to image, scaled from the pyramid of orig when given"
     x_strip = int(((size[0] - img.size[0]) / 2) + 0.9)
     y_strip = int(size[1] - img.size[1])
     log.debug(f"strips: {x_strip} {y_strip}")
@@ -139,20 +257,24 @@ def stripe_image(img: Image, orig: Image, size: tuple[int, int]) -> Image:
         striped_img = imnew("RGB", size)
         if x_strip and y_strip:
             log.debug("dual strips")
-            x_stripe(x_strip, orig, img.size[0], striped_img, size)
+            x_stripe(
+                x_strip, orig, img.size[0], striped_img, size, screen, levels
+            )
             ys_size = (size[0] - (x_strip * 2), y_strip)
             log.debug("y strip")
-            y_img = make_strip(orig, ys_size)
+            y_img = make_strip(orig, ys_size, screen, levels)
             striped_img.paste(y_img, (x_strip, 0))
             striped_img.paste(img, (x_strip, y_strip))
         elif x_strip:
             log.debug("single x strip")
-            x_stripe(x_strip, orig, img.size[0], striped_img, size)
+            x_stripe(
+                x_strip, orig, img.size[0], striped_img, size, screen, levels
+            )
             striped_img.paste(img, (x_strip, 0))
         elif y_strip:
             log.debug("single y strip")
             ys_size = (size[0], y_strip)
-            y_img = make_strip(orig, ys_size)
+            y_img = make_strip(orig, ys_size, screen, levels)
             striped_img.paste(y_img, (0, 0))
             striped_img.paste(img, (0, y_strip))
     else:
@@ -160,10 +282,12 @@ def stripe_image(img: Image, orig: Image, size: tuple[int, int]) -> Image:
     return striped_img
 
 
-def xfwm4(bg_name: str) -> None:
-    "set background xfwm4"
-    bg1_name = pjoin(BG_HOME, BG_SWITCH[0])
-    bg2_name = pjoin(BG_HOME, BG_SWITCH[1])
+def xfwm4(bg_name: str, monitor="") -> None:
+    "set background xfwm4, on one monitor when named"
+    (base, ext) = splitext(bg_name)
+    bg1_name = base + BG_SWITCH[0] + ext
+    bg2_name = base + BG_SWITCH[1] + ext
+    target = basename(bg_name)
     if exists(bg1_name):
         remove(bg1_name)
         if exists(bg2_name):
@@ -172,11 +296,9 @@ def xfwm4(bg_name: str) -> None:
         # choose bg2
         # copy(bg_name, bg2_name)
         try:
-            symlink(BG_NAME, bg2_name)
+            symlink(target, bg2_name)
         except OSError:
-            log.warning(
-                f"Failed to create symlink: {BG_NAME} -> {BG_SWITCH[1]}"
-            )
+            log.warning(f"Failed to create symlink: {target} -> {bg2_name}")
         bg_name = bg2_name
     else:
         if exists(bg2_name):
@@ -184,27 +306,11 @@ def xfwm4(bg_name: str) -> None:
         # choose bg1
         # copy(bg_name, bg1_name)
         try:
-            symlink(BG_NAME, bg1_name)
+            symlink(target, bg1_name)
         except OSError:
-            log.warning(
-                f"Failed to create symlink: {BG_NAME} -> {BG_SWITCH[0]}"
-            )
+            log.warning(f"Failed to create symlink: {target} -> {bg1_name}")
         bg_name = bg1_name
-    lines = check_output(
-        ["xfconf-query", "--channel", "xfce4-desktop", "--list"]
-    ).decode(ENC)
-    for line in lines.split("\n"):
-        prop = line.strip()
-        if prop.find("image-style") > 0:
-            check_call(
-                ["xfconf-query", "--channel", "xfce4-desktop", "--property"]
-                + [prop, "--set", "1"]
-            )
-        if prop.find("last-image") > 0 or prop.find("image-path") > 0:
-            check_call(
-                ["xfconf-query", "--channel", "xfce4-desktop", "--property"]
-                + [prop, "--set", bg_name]
-            )
+    set_image(bg_name, monitor)
 
 
 def windows(bg_name: str) -> None:
@@ -214,28 +320,260 @@ def windows(bg_name: str) -> None:
     windll.user32.SystemParametersInfoW(20, 0, bg_name, 3)
 
 
+def draft_size(size: tuple[int, int], res: tuple[int, int], margin=None):
+    "smallest size worth asking the decoder for, None for a full decode"
+    if margin is None:
+        margin = DECODE_MODES[decode_mode[0]]
+    ratio = min(res[0] / float(size[0]), res[1] / float(size[1]))
+    if not margin or ratio * margin > 0.5:
+        return None
+    return (ceil(size[0] * ratio * margin), ceil(size[1] * ratio * margin))
+
+
+def over_budget(size: tuple[int, int]) -> bool:
+    "would decoding this many pixels break the pixel budget"
+    return bool(pixel_max[0]) and size[0] * size[1] > pixel_max[0]
+
+
+def open_image(img: str, res: tuple[int, int]) -> Image:
+    "open an image as RGB, raising BadImage when it cannot be decoded"
+    try:
+        return decode_image(img, res)
+    except (OSError, SyntaxError, ValueError) as e:
+        raise BadImage(img, f"Unable to decode {img}: {e}") from e
+
+
+def decode_image(img: str, res: tuple[int, int]) -> Image:
+    "open an image as RGB, decoding JPEGs at a reduced scale when allowed"
+    start = perf_counter()
+    with stage("decode"):
+        image: Image = imopen(img)
+        full = image.size
+        note(width=full[0], height=full[1], mode=image.mode)
+        if image.format == "JPEG":
+            want = draft_size(full, res)
+            if want is None and over_budget(full):
+                # decode as small as still fills res rather than skip it
+                want = draft_size(full, res, 1)
+            if want:
+                image.draft("RGB", want)
+        if over_budget(image.size):
+            image.close()
+            raise ImageTooLarge(
+                img,
+                f"Image too large, {full[0]}x{full[1]} would decode to "
+                f"{image.size[0] * image.size[1] / 10**6:.0f} megapixels: "
+                f"{img}"
+            )
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        else:
+            image.load()
+    if image.size != full:
+        saved = (full[0] * full[1] - image.size[0] * image.size[1]) * 3
+        log.debug(
+            f"draft decode {image.size} of {full} in "
+            f"{perf_counter() - start:.3f}s, {saved / 2**20:.1f} MiB saved"
+        )
+    return image
+
+
+def compose(
+    image: Image, res: tuple[int, int], levels: Pyramid | None = None
+) -> Image:
+    """scale, tile and stripe a decoded image to fill res, the centre and
+    strips sharing levels, the pyramid of image"""
+    log.debug(f"image size: {image.size}")
+    levels = levels or Pyramid(image)
+    with stage("scale"):
+        new_img = scale_image(image, res, res, levels)
+    with stage("tile"):
+        new_img = tile_image(new_img, res)
+    with stage("stripe"):
+        new_img = stripe_image(new_img, image, res, res, levels)
+    return new_img
+
+
+def save_image(img: Image, dst: str) -> None:
+    """encode a render in the selected output format, through a new file
+    that replaces dst so a failed save leaves dst as it was"""
+    options: dict = {"format": ENCODERS[out_format[0]][0]}
+    if out_format[0] == "jpeg":
+        options["quality"] = quality[0]
+        if subsampling[0]:
+            options["subsampling"] = subsampling[0]
+    if optimize[0]:
+        options["optimize"] = True
+    # unique per process and thread, created with the usual permissions
+    tmp = f"{dst}.{getpid()}-{get_ident()}.tmp"
+    if exists(tmp):
+        remove(tmp)
+    try:
+        img.save(tmp, **options)
+        replace(tmp, dst)
+    except BaseException:
+        remove(tmp)
+        raise
+
+
+def passthrough(img: str) -> tuple[int, int] | None:
+    "the size at which the source file can be shown as it is, if any"
+    if out_format[0] != "jpeg":
+        return None
+    try:
+        with imopen(img) as image:
+            if image.format != "JPEG" or image.mode != "RGB":
+                return None
+            if image.getexif().get(ORIENTATION, 1) != 1:
+                return None
+            return image.size
+    except (OSError, SyntaxError, ValueError):
+        # open_image reports it
+        return None
+
+
 def gen_image(img: str, dst: str) -> None:
     "generate background image of preset size"
     log.debug(f"Generating image: {dst}")
-    image: Image = imopen(img)
-    if image.mode != "RGB":
-        image = image.convert("RGB")
-    log.debug(f"image size: {image.size}")
     res = (r[0], r[1])
-    new_img = scale_image(image, res)
-    new_img = tile_image(new_img, res)
-    new_img = stripe_image(new_img, image, res)
-    new_img.save(dst)
+    if passthrough(img) == res:
+        log.debug(f"passing through: {img}")
+        # a copy as a link would let a later sync write into the source
+        copy(img, dst)
+        return
+    new_img = compose(open_image(img, res), res)
+    with stage("save"):
+        save_image(new_img, dst)
 
 
-def set_background(img: str) -> None:
-    "set background image"
-    log.debug(f"image file: {img}")
-    bg_name = pjoin(BG_HOME, BG_NAME)
-    gen_image(img, bg_name)
+def screens() -> list[Target]:
+    "the monitors to render for, one covering them all unless per monitor"
+    if per_monitor[0] and len(monitors) > 1 and system_name == "Linux":
+        return [(name, (w, h)) for (name, w, h) in monitors]
+    return [("", (r[0], r[1]))]
+
+
+@cache
+def monitor_pool() -> ThreadPoolExecutor:
+    "threads rendering the monitors of one change in parallel"
+    return ThreadPoolExecutor(MONITOR_WORKERS, thread_name_prefix="monitor")
+
+
+def render(job: tuple[Pyramid, tuple[int, int], str]) -> None:
+    "compose one decoded image for one size and save it"
+    (levels, res, dst) = job
+    save_image(compose(levels.source, res, levels), dst)
+
+
+def stage_image(imgs: tuple[str, ...]) -> Staged:
+    """render ahead of display, one image for every monitor or one each,
+    returning the finished render for each monitor"""
+    begin("render", image=", ".join(imgs))
+    staged: Staged = []
+    try:
+        with stage("render"):
+            targets = screens()
+            sources = imgs if len(imgs) > 1 else imgs * len(targets)
+            # source -> render path -> (size, cache key)
+            misses: dict[str, dict[str, tuple]] = {}
+            for img, (mon, res) in zip(sources, targets):
+                if not cache_max[0]:
+                    path = pjoin(BG_HOME, STAGE_DIR, stage_name(img, res))
+                    misses.setdefault(img, {})[path] = (res, None)
+                    staged.append((mon, path))
+                    continue
+                key = cache_key(img, res, decode_mode[0], *encoding())
+                # fetched or pinned until apply_background releases it
+                entry = fetch(key)
+                if entry is None:
+                    pin(key)
+                    misses.setdefault(img, {})[part_path(key)] = (res, key)
+                    entry = entry_path(key)
+                staged.append((mon, entry))
+            note(cached=not misses, monitors=len(targets))
+            render_misses(misses)
+            return staged
+    except BaseException:
+        if cache_max[0]:
+            release([path for _, path in staged])
+        raise
+    finally:
+        end()
+
+
+def render_misses(misses: dict[str, dict[str, tuple]]) -> None:
+    "decode each source once at the largest size it is needed and render"
+    jobs = []
+    for img, paths in misses.items():
+        same = passthrough(img)
+        need = {}
+        for path, (res, _) in paths.items():
+            if res == same:
+                log.debug(f"passing through: {img}")
+                # a copy, as touching a cache hit would touch a linked source
+                copy(img, path)
+            else:
+                need[path] = res
+        note(passthrough=len(need) < len(paths))
+        if not need:
+            continue
+        sizes = need.values()
+        largest = (max(x for x, _ in sizes), max(y for _, y in sizes))
+        # monitors of the same source shrink from the same levels
+        levels = Pyramid(open_image(img, largest))
+        jobs += [(levels, res, path) for path, res in need.items()]
+    if len(jobs) == 1:
+        (levels, res, path) = jobs[0]
+        new_img = compose(levels.source, res, levels)
+        with stage("save"):
+            save_image(new_img, path)
+    elif jobs:
+        with stage("compose"):
+            list(monitor_pool().map(render, jobs))
+    for paths in misses.values():
+        for res, key in paths.values():
+            if key:
+                store(key)
+
+
+def stage_name(img: str, res: tuple[int, int]) -> str:
+    "file name for an uncached staged render"
+    name = f"{img}|{res[0]}x{res[1]}"
+    return sha1(name.encode(ENC)).hexdigest() + out_ext()
+
+
+def bg_file(monitor: str) -> str:
+    "name of the background file shown on a monitor"
+    base = splitext(BG_NAME)[0]
+    if not monitor:
+        return base + out_ext()
+    return f"{base}-{monitor}{out_ext()}"
+
+
+def apply_background(staged: Staged) -> None:
+    "swap staged renders in as the backgrounds and tell the WM"
+    begin("apply")
+    try:
+        with stage("publish"):
+            for mon, path in staged:
+                publish(path, pjoin(BG_HOME, bg_file(mon)))
+            if cache_max[0]:
+                release([path for _, path in staged])
+            else:
+                for path in set(path for _, path in staged):
+                    remove(path)
+        with stage("wm"):
+            for mon, _ in staged:
+                set_wm(pjoin(BG_HOME, bg_file(mon)), mon)
+    finally:
+        end()
+
+
+def set_wm(bg_name: str, monitor="") -> None:
+    "point the window manager at the background file"
     if system_name == "Linux":
         if window_manager[0] == "Xfwm4":
-            xfwm4(bg_name)
+            xfwm4(bg_name, monitor)
         else:
             raise SetBGException(f"Unsupported Linux WM: {window_manager[0]}")
     elif system_name == "Windows":
@@ -244,6 +582,12 @@ def set_background(img: str) -> None:
         raise SetBGException(f"Unsupported OS: {system_name}")
 
 
+def set_background(img: str) -> None:
+    "set background image"
+    log.debug(f"image file: {img}")
+    apply_background(stage_image((img,)))
+
+
 def cli_setbg() -> None:
     "main entry point for SetBG CLI"
     try:
@@ -252,14 +596,15 @@ def cli_setbg() -> None:
         parser.add_argument("FILE", help="File to set on background")
         args = base_arg_handler(parser)
         img = check_image(args.FILE, True)
-        set_background(img)
+        with profiled(NAME):
+            set_background(img)
     except SetBGException as e:
         log.error(str(e))
 
 
 def rsbg() -> None:
     "set background to default image"
-    set_background(RSBG_IMG)
+    set_background(rsbg_image())
 
 
 def cli_rsbg() -> None:
@@ -0,0 +1,166 @@
+from collections.abc import Callable, Iterable
+from heapq import heappop, heappush
+from logging import getLogger
+from os import stat
+from queue import Empty, Queue
+from threading import Thread
+from time import monotonic, sleep, time
+from typing import Self
+
+from os.path import join as pjoin
+
+from PIL.Image import open as imopen
+
+from setbg.common import BG_HOME, ENC, LNAME, QUARANTINE_NAME
+from setbg.common import VALIDATE_BATCH, VALIDATE_PAUSE, VALIDATE_SETTLE
+from setbg.index import ScanIndex
+
+log = getLogger(LNAME)
+
+Header = tuple[str, int, int, str, str]  # format, width, height, mode, error
+
+
+def probe(path: str) -> Header:
+    "read an image header without decoding, error is empty when it is good"
+    try:
+        with imopen(path) as image:
+            (width, height) = image.size
+            header = (image.format or "", width, height, image.mode)
+    except (OSError, SyntaxError, ValueError) as e:
+        return ("", 0, 0, "", str(e) or type(e).__name__)
+    if not width or not height:
+        return (*header, "empty image")
+    return (*header, "")
+
+
+class Validator:
+    "Check image headers on a background thread, caching the results"
+
+    def __init__(
+        self: Self,
+        index: ScanIndex | None,
+        on_bad: Callable[[str, str], None],
+    ) -> None:
+        "report bad files to on_bad(path, error)"
+        self.index = index
+        self.on_bad = on_bad
+        self.queue: Queue[str] = Queue()
+        # (when to look again, path) of files still being written
+        self.waiting: list[tuple[float, str]] = []
+        self.thread: Thread | None = None
+        self.stats = {"probed": 0, "cached": 0, "bad": 0}
+        self.dirty = False
+
+    def submit(self: Self, paths: Iterable[str]) -> None:
+        "queue files to check, starting the worker on first use"
+        for fp in paths:
+            self.queue.put(fp)
+        if not self.thread:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def check(self: Self, fp: str) -> str:
+        "error of a file's header check, probing it unless cached"
+        try:
+            st = stat(fp)
+        except OSError as e:
+            return str(e)
+        error = None
+        if self.index:
+            error = self.index.probed(fp, st.st_size, st.st_mtime_ns)
+        if error is not None:
+            self.stats["cached"] += 1
+            return error
+        header = probe(fp)
+        self.stats["probed"] += 1
+        self.dirty = True
+        if self.index:
+            self.index.store_probe(fp, st.st_size, st.st_mtime_ns, header)
+        return header[-1]
+
+    def valid(self: Self, paths: list[str]) -> list[str]:
+        "the files that pass, reporting the others"
+        good = []
+        for fp in paths:
+            error = self.check(fp)
+            if error:
+                self.bad(fp, error)
+            else:
+                good.append(fp)
+        if self.index:
+            self.index.commit()
+        return good
+
+    def bad(self: Self, fp: str, error: str) -> None:
+        "count and report a file that failed"
+        self.stats["bad"] += 1
+        self.dirty = True
+        self.on_bad(fp, error)
+
+    def mark(self: Self, fp: str, error: str) -> None:
+        "record a file that passed its header check but failed to decode"
+        if not self.index:
+            return
+        try:
+            st = stat(fp)
+        except OSError:
+            return
+        self.index.store_probe(
+            fp, st.st_size, st.st_mtime_ns, ("", 0, 0, "", error)
+        )
+        self.submit([fp])
+
+    def run(self: Self) -> None:
+        "check queued files, pausing between batches to stay in the back"
+        probed = self.stats["probed"]
+        while True:
+            fp = self.next()
+            error = self.check(fp)
+            if error:
+                self.bad(fp, error)
+            if self.stats["probed"] - probed >= VALIDATE_BATCH:
+                probed = self.stats["probed"]
+                if self.index:
+                    self.index.commit()
+                sleep(VALIDATE_PAUSE)
+            if self.queue.empty() and self.dirty:
+                self.idle()
+
+    def next(self: Self) -> str:
+        """the next file to check, holding back files modified in the last
+        VALIDATE_SETTLE seconds as they may still be being copied"""
+        while True:
+            delay = None
+            if self.waiting:
+                delay = self.waiting[0][0] - monotonic()
+            if delay is not None and delay <= 0:
+                fp = heappop(self.waiting)[1]
+            else:
+                try:
+                    fp = self.queue.get(timeout=delay)
+                except Empty:
+                    continue
+            try:
+                age = time() - stat(fp).st_mtime
+            except OSError:
+                # check reports it
+                return fp
+            if age >= VALIDATE_SETTLE:
+                return fp
+            heappush(self.waiting, (monotonic() + VALIDATE_SETTLE - age, fp))
+
+    def idle(self: Self) -> None:
+        "everything queued is checked, save and write the report"
+        self.dirty = False
+        if not self.index:
+            return
+        self.index.commit()
+        bad = self.index.quarantined()
+        with open(pjoin(BG_HOME, QUARANTINE_NAME), "w", encoding=ENC) as fp:
+            for path, error in bad:
+                fp.write(f"{path}\t{error}\n")
+        log.info(
+            f"validated: {self.stats['probed']} probed, "
+            f"{self.stats['cached']} cached, {self.stats['bad']} bad, "
+            f"{len(bad)} in {QUARANTINE_NAME}"
+        )
@@ -0,0 +1,61 @@
+from os.path import sep
+from typing import Self
+
+from watchdog.events import FileSystemEventHandler
+
+from setbg.common import SetBGException
+
+from setbg.common import D_EXCLUDE
+from setbg.common import check_image
+from setbg import rbg
+
+
+def excluded(path: str) -> bool:
+    "is the path inside an excluded directory"
+    return not D_EXCLUDE.isdisjoint(path.split(sep))
+
+
+class FSHandler(FileSystemEventHandler):
+    "File System Event Handler applying each change to the image list"
+
+    def on_created(self: Self, event):
+        "add a new image or the images in a new directory"
+        self.added(str(event.src_path), event.is_directory)
+
+    def on_deleted(self: Self, event):
+        "remove a deleted image or the images in a deleted directory"
+        self.removed(str(event.src_path), event.is_directory)
+
+    def on_closed(self: Self, event):
+        "a file written in place may be a quarantined one now complete"
+        self.added(str(event.src_path), event.is_directory)
+
+    def on_moved(self: Self, event):
+        "treat a move as a delete and a create"
+        self.removed(str(event.src_path), event.is_directory)
+        self.added(str(event.dest_path), event.is_directory)
+
+    def added(self: Self, path: str, is_dir: bool) -> None:
+        "add images for a created path, as the poller does"
+        if excluded(path):
+            return
+        if is_dir:
+            found = rbg.images.scan_tree(path)
+        else:
+            try:
+                found = [check_image(path)]
+            except SetBGException:
+                return
+        rbg.images.update(found, [])
+
+    def removed(self: Self, path: str, is_dir: bool) -> None:
+        """remove images for a deleted path, as the poller does so a copy
+        of a deleted duplicate takes its place"""
+        if is_dir:
+            prefix = path.rstrip(sep) + sep
+            gone = rbg.images.remove_tree(path)
+            dupes = list(rbg.images.dupes)
+            gone += [fp for fp in dupes if fp.startswith(prefix)]
+        else:
+            gone = [path]
+        rbg.images.update([], gone)
@@ -0,0 +1,86 @@
+from logging import getLogger
+from subprocess import DEVNULL, Popen, check_output
+from time import monotonic
+
+from setbg.common import SetBGException
+
+from setbg.common import ENC, LNAME, XFCONF_REFRESH
+
+log = getLogger(LNAME)
+
+XFCONF = ["xfconf-query", "--channel", "xfce4-desktop"]  # base command
+STYLE = "1"  # image-style value, centered
+
+image_props: list[str] = []  # last-image and image-path properties
+styled: set[str] = set()  # image-style properties already set
+monitors: list[tuple] = []  # monitor layout the properties were read for
+refreshed = [0.0]  # when the property list was last read
+
+
+def monitor_layout() -> list[tuple]:
+    "names and geometry of the connected monitors"
+    from screeninfo import ScreenInfoError, get_monitors
+
+    try:
+        found = get_monitors()
+    except ScreenInfoError:
+        return []
+    return [(m.name, m.x, m.y, m.width, m.height) for m in found]
+
+
+def run_all(cmds: list[list[str]]) -> bool:
+    "run commands concurrently, True if they all succeeded"
+    procs = [Popen(cmd, stdout=DEVNULL) for cmd in cmds]
+    return all([proc.wait() == 0 for proc in procs])
+
+
+def refresh() -> None:
+    "read the desktop properties and set any new image styles"
+    lines = check_output(XFCONF + ["--list"]).decode(ENC)
+    props = [line.strip() for line in lines.split("\n")]
+    image_props[:] = [
+        p for p in props if "last-image" in p or "image-path" in p
+    ]
+    styles = [p for p in props if "image-style" in p and p not in styled]
+    if not run_all(set_cmds(styles, STYLE)):
+        raise SetBGException("xfconf-query failed setting image style")
+    styled.update(styles)
+    monitors[:] = monitor_layout()
+    refreshed[0] = monotonic()
+    log.debug(f"xfconf: {len(image_props)} images, {len(styles)} styled")
+
+
+def set_cmds(props: list[str], value: str) -> list[list[str]]:
+    "one xfconf-query command per property"
+    return [XFCONF + ["--property", p, "--set", value] for p in props]
+
+
+def stale() -> bool:
+    "has the monitor layout changed or the property list aged out"
+    if not image_props or monotonic() - refreshed[0] > XFCONF_REFRESH:
+        return True
+    return monitor_layout() != monitors
+
+
+def monitor_props(monitor: str) -> list[str]:
+    "image properties of one monitor, or of them all"
+    if not monitor:
+        return image_props
+    return [p for p in image_props if f"/monitor{monitor}/" in p]
+
+
+def set_image(bg_name: str, monitor="") -> None:
+    "point the image properties at bg_name, rereading them on failure"
+    if stale():
+        refresh()
+    props = monitor_props(monitor)
+    if props and run_all(set_cmds(props, bg_name)):
+        return
+    log.info("xfconf-query failed, rereading properties")
+    styled.clear()
+    refresh()
+    props = monitor_props(monitor)
+    if not props:
+        raise SetBGException(f"No xfconf image properties for {monitor}")
+    if not run_all(set_cmds(props, bg_name)):
+        raise SetBGException("xfconf-query failed setting background")